@@ -21,15 +21,16 @@
 # md5 bank 0 8603efa8aadb3a6da3c39be41717be10
 # md5 bank 1 2464468d155d8989ef0b83c851143450
 
-from hashlib import md5
+# hashlib, re, argparse and others are imported where needed, to keep the start-up
+# time low for the server workers and other users of the module
 import sys
-import argparse
 
 class MyException(Exception):
     pass
 
 class HP67():
     _rom = {}
+    _used = bytearray(8192)     # occupancy bitmap of _rom, 1: word written
     _labels = {}
     _last_global = ''
     _pc = 0
@@ -46,6 +47,38 @@ class HP67():
     _do_line = True             # 1/true: process source lines
     _do_line_skip_elses = False # 1/true: one if/elif caluse was - all elses are skipped
     _do_line_stack = []         # [do_line, do_line_skip_elses] history
+    _macros = {}                # name: (params, body lines, position of the definition)
+    _macro_pos = 0              # lines read in the pass, macro expansions included
+    _macro_memo = {}            # (name, args): expanded lines, valid for all passes
+    _macro_count = 0            # invocation counter, used for unique local labels
+    _file_in = ''
+    _line_no = 0                # source line number, macro expansions use the invocation line
+    _collect = 0                # 1: collect all diagnostics and report them at the end (--diag)
+    _diags = []                 # diagnostics: file, line, address, severity, code, message
+    _diag_keys = set()          # reported diagnostics, errors may repeat in each pass
+    _dup_labels = set()         # lines with a duplicate label, ignored in pass 1,2..
+    _predefines = {}            # defines given by the caller, eg. the server
+    _listing = None             # listing entries of the last pass, None: no listing
+    _only = None                # selected addresses (--only), 1: selected, None: all
+    _refs = None                # label names referenced in the last pass
+    _orgs = []                  # org addresses of the last pass (with bank)
+    _publics = []               # public symbol addresses of the last pass (with bank)
+    _optimize = 0               # 1: peephole optimizer (-O)
+    _rewrites = {}              # -O: expanded line index: (new line, note, [(kind, cycles)])
+    _opt_stats = {}             # -O: rewrites per kind, cycles saved, words before
+    _opt_fixed = {}             # -O: lines not removed: address of the "$" branch or dispatch
+    _opt_base = set()           # -O: lines of the out of range branches without rewrites
+    _opt_dropped = set()        # -O: lines of the rewrites dropped, not rewritten again
+    _opt_pairs = {}             # -O: tail call, jsb line: return line and back
+    _opt_warned = set()         # -O: lines reported as fixed
+    _shm = None                 # shared memory segment of publish_image(), kept open
+    _tramp = 0                  # 1: trampolines for out of range branches (--trampolines)
+    _tramps = {}                # trampoline address: [target, target name, words, sites]
+    _tramp_sites = {}           # branch address: trampoline address
+    _tramp_failed = set()       # branch addresses without room for a trampoline
+    _tramp_requests = []        # branches of the current pass without a trampoline
+    _tramp_note = ''            # listing comment of the current line
+    _occupied = None            # words of the current pass (-1: free), for the trampolines
     
     _pass = 0
 
@@ -181,7 +214,118 @@ class HP67():
                   '1 -> p', '3 -> p', '13 -> p', '6 -> p',
                   '0 -> p', '9 -> p', '5 -> p', '14 -> p')  # 14 -> p, invalid or same as 0 -> p?
 
-    _op_branch = ('then go to', 'if n/c go to', 'go to', 'jsb', 'if no carry go to')
+    # branch mnemonics: mnemonic, kind (index in _op_branch_kinds), dialect ('': all)
+    _op_branch = (('then go to', 0, ''), ('if n/c go to', 1, 'short'), ('go to', 2, ''),
+                  ('jsb', 3, ''), ('if no carry go to', 4, 'long'))
+    _op_branch_kinds = ('then go to', 'if n/c go to', 'go to', 'jsb', 'if no carry go to')
+
+    # misc tables in match order: table, row (code bits 2..5), 1: sets "if" for "then go to",
+    # dialect ('': all, short: nonpareil style, long: HP listing style)
+    _op_misc_order = (('_op_misc_0a', 0, 0, 'short'), ('_op_misc_0b', 0, 0, 'long'), ('_op_misc_1', 1, 0, ''),
+                      ('_op_misc_2a', 2, 0, 'short'), ('_op_misc_2b', 2, 0, 'long'), ('_op_misc_3', 3, 0, ''),
+                      ('_op_misc_4a', 4, 0, 'short'), ('_op_misc_4b', 4, 0, 'long'), ('_op_misc_5', 5, 1, ''),
+                      ('_op_misc_6', 6, 0, ''), ('_op_misc_7', 7, 1, ''), ('_op_misc_8', 8, 0, ''),
+                      ('_op_misc_9', 9, 1, ''), ('_op_misc_A1', 10, 0, 'short'), ('_op_misc_A2', 10, 0, 'long'),
+                      ('_op_misc_B', 11, 1, ''),
+                      ('_op_misc_E1', 14, 0, 'short'), ('_op_misc_E2', 14, 0, 'long'),  # must do E before C, else match on "c -> data"
+                      ('_op_misc_C2', 12, 0, 'long'), ('_op_misc_C1', 12, 0, 'short'),  # must do C2 before C1, else match on "c -> data"
+                      ('_op_misc_D1', 13, 0, 'short'), ('_op_misc_D2', 13, 0, 'long'), ('_op_misc_F', 15, 0, ''))
+
+    # compiled tables, see _load_tables() and load_isa()
+    _tables_version = 2
+    _tables = None              # the compiled built-in (HP67/97) tables
+    _isa_name = 'hp67'
+    _dialect = 'any'            # any, a dialect of the isa, or strict: the first dialect used
+    _dialect_lock = 'any'       # the dialect in use, '': strict, not yet known
+    _lookup_misc = None
+    _lookup_arith = None
+    _lookup_branch = None
+    _lookup_dialect = 'any'     # the dialect of the lookup tables
+    _memo = None                # decoded lines of the tables, see _decode()
+    _decoded = {}               # decoded lines of the assembly as written, see _decode()
+    _memo_size = 4096           # max. number of decoded lines kept
+
+    # create a diagnostic record for the current line
+    def _diag(self, severity, code, message, text=None):
+        diag = {'file': self._file_in, 'line': self._line_no,
+                'address': self._pc | (self._bank << 12),
+                'severity': severity, 'code': code, 'message': message}
+        if (text != None):
+            diag['text'] = text
+        return diag
+
+    def _add_diag(self, diag):
+        key = (diag['line'], diag['code'], diag['message'], diag.get('text'))
+        if key not in self._diag_keys:
+            self._diag_keys.add(key)
+            self._diags.append(diag)
+
+    # raise an error, the location is printed unless diagnostics are collected
+    def _error(self, code, message, text=None):
+        e = MyException('Error: ' + message)
+        e.diag = self._diag('error', code, message, text)
+        if (not self._collect and text != None):
+            print("0x%X%03X: " % (self._bank, self._pc), text)
+        raise e
+
+    # report an error the caller can recover from, raised unless diagnostics are collected
+    def _soft_error(self, code, message, text=None):
+        if (self._collect):
+            self._add_diag(self._diag('error', code, message, text))
+        else:
+            self._error(code, message, text)
+
+    # report a warning or info message
+    def _note(self, severity, code, message, text=None):
+        if (self._collect):
+            self._add_diag(self._diag(severity, code, message, text))
+        elif (severity == 'warning'):
+            if (text != None):
+                print("0x%X%03X: " % (self._bank, self._pc), text)
+            print('Warning: ' + message)
+        elif (text != None):
+            print('Info: %s at 0x%X%03X:' % (message, self._bank, self._pc), text)
+        else:
+            print('Info: ' + message)
+
+    # record a raised error when diagnostics are collected, else pass it on
+    def _recover(self, e):
+        if (not self._collect or not hasattr(e, 'diag')):
+            raise e
+        self._add_diag(e.diag)
+
+    # recover from an opcode error, an instruction is replaced by a 0x000 word to
+    # keep the addresses of the following lines
+    def _recover_opcode(self, e, ll):
+        self._recover(e)
+        if (ll[0] in ('org', 'bank', 'public')):
+            return (-1, len(ll),)
+        return (0x000, len(ll),)
+
+    # collected diagnostics sorted by line, and the number of errors and warnings
+    def _diag_summary(self):
+        diags = sorted(self._diags, key=lambda d: d['line'])
+        errors = len([d for d in diags if d['severity'] == 'error'])
+        warnings = len([d for d in diags if d['severity'] == 'warning'])
+        return diags, errors, warnings
+
+    # report the collected diagnostics, returns the number of errors
+    def _report_diags(self, diag, file_diag):
+        diags, errors, warnings = self._diag_summary()
+        if (diag == 'json'):
+            import json
+            f = open(file_diag, 'wt')
+            json.dump({'errors': errors, 'warnings': warnings, 'diagnostics': diags}, f, indent=1)
+            f.write('\n')
+            f.close()
+        else:
+            for d in diags:
+                print('%s:%d: 0x%04X: %s: %s [%s]' % (d['file'], d['line'], d['address'],
+                                                     d['severity'], d['message'], d['code']))
+                if ('text' in d):
+                    print('    ' + d['text'])
+        print('%d error(s), %d warning(s)' % (errors, warnings))
+        return errors
 
     def _get_address(self, l):
         addr = 0
@@ -192,138 +336,305 @@ class HP67():
                 else:
                     addr = int(l[0:], 0)
             except:
-                print("0x%X%03X: " % (self._bank, self._pc), l)
-                raise MyException('Error: Bad address')
+                self._error('bad-address', 'Bad address', l)
         return addr
 
-    def _match(self, l, ops):
-        found = -1
-        length = 0
-        j = 0
-        ## print('ops=', ops, " ll=", l)
-        for op in ops:
-            o = op.split()
-            o_l = len(o)
-            l_l = len(l)
-            if (o_l <= l_l):
-                nok = 0
-                for i in range(o_l):
-                    if (o[i].lower() != l[i].lower()):
-                        nok = 1
-                        break
-                if (nok == 0):
-                    length = o_l
-                    found = j
-                    ##print('--found=', j, ' len=', length, ' op=', op) ###
-            j = j + 1
-            if (found >= 0):
+    # the built-in HP67/97 instruction set as an isa definition, see load_isa()
+    @classmethod
+    def isa_definition(cls):
+        return {'name': 'hp67',
+                'tef': list(cls._op_tef),
+                'arith': [[op, cy] for op, cy in zip(cls._op_arith, cls._op_arith_cy)],
+                'branch': [list(b) for b in cls._op_branch],
+                'misc': [{'row': row, 'ifthen': ifthen, 'dialect': dialect, 'ops': list(getattr(cls, name))}
+                         for name, row, ifthen, dialect in cls._op_misc_order]}
+
+    # write the built-in isa definition as json to f, one entry per line
+    @classmethod
+    def dump_isa(cls, f):
+        import json
+        isa = cls.isa_definition()
+        f.write('{\n "name": %s,\n "tef": %s,\n' % (json.dumps(isa['name']), json.dumps(isa['tef'])))
+        for key in ('arith', 'branch', 'misc'):
+            f.write(' "%s": [\n  ' % key)
+            f.write(',\n  '.join([json.dumps(e) for e in isa[key]]))
+            f.write('\n ]%s\n' % (',' if (key != 'misc') else ''))
+        f.write('}\n')
+
+    # compile an isa definition into dicts of first token: [(tokens, ...)] for each dialect,
+    # and 'any' for all dialects. The entries are in match order, ie. the first entry
+    # matching the line is used. A spelling in several dialects belongs to all ('')
+    @classmethod
+    def _compile_tables(cls, isa):
+        entries = []
+        tags = {}
+        for t in isa['misc']:
+            col = 0
+            for op in t['ops']:
+                tokens = op.lower().split()
+                code = col << 6 | t['row'] << 2
+                entries.append((tokens, code, t['ifthen'], t['dialect']))
+                tags.setdefault((" ".join(tokens), code), set()).add(t['dialect'])
+                col = col + 1
+        for op, kind, dialect in isa['branch']:
+            tags.setdefault((" ".join(op.lower().split()), -1 - kind), set()).add(dialect)
+        dialects = set([d for t in tags.values() for d in t if (d != '')])
+        misc = {'any': {}}
+        branch = {'any': {}}
+        for d in dialects:
+            misc[d] = {}
+            branch[d] = {}
+        for tokens, code, ifthen, dialect in entries:
+            if (len(tags[(" ".join(tokens), code)]) > 1):
+                dialect = ''
+            for d in misc.keys():
+                if (d == 'any' or dialect == '' or dialect == d):
+                    misc[d].setdefault(tokens[0], []).append((tokens, code, ifthen, dialect))
+        for op, kind, dialect in isa['branch']:
+            tokens = op.lower().split()
+            if (len(tags[(" ".join(tokens), -1 - kind)]) > 1):
+                dialect = ''
+            for d in branch.keys():
+                if (d == 'any' or dialect == '' or dialect == d):
+                    branch[d].setdefault(tokens[0], []).append((tokens, kind, dialect))
+        arith = {}
+        k = 0
+        for tef in isa['tef']:
+            found = 0
+            for op, cy in isa['arith']:
+                tokens = (op % tef).lower().split()
+                arith.setdefault(tokens[0], []).append((tokens, found, k))
+                found = found + 1
+            k = k + 1
+        return {'name': isa['name'], 'misc': misc, 'arith': arith, 'branch': branch,
+                'arith_cy': [cy for op, cy in isa['arith']]}
+
+    # load an isa definition (json) for another Woodstock machine, replaces the built-in
+    # HP67/97 tables of this assembler. See isa_definition() for the format
+    def load_isa(self, file_name):
+        import json
+        f = open(file_name, 'rt')
+        try:
+            isa = json.load(f)
+        except ValueError as e:
+            raise MyException('Error: bad isa file %s: %s' % (file_name, e))
+        finally:
+            f.close()
+        try:
+            ok = (len(isa['tef']) == 8 and len(isa['arith']) == 32 and
+                  all([len(op) == 2 and '%s' in op[0] and op[1] in (0, 1) for op in isa['arith']]) and
+                  all([len(b) == 3 and b[1] in range(5) for b in isa['branch']]) and
+                  all([len(t['ops']) == 16 and t['row'] in range(16) and t['ifthen'] in (0, 1) and
+                       isinstance(t['dialect'], str) for t in isa['misc']]))
+        except (KeyError, TypeError):
+            ok = False
+        if (not ok):
+            raise MyException('Error: bad isa file %s: tef (8), arith (32), branch and misc (16 ops each) expected' % file_name)
+        isa.setdefault('name', file_name)
+        self._tables = self._compile_tables(isa)
+        self._op_arith_cy = tuple(self._tables['arith_cy'])
+        self._isa_name = isa['name']
+
+    # select the dialect: 'any', 'strict' (the dialect of the first dialect specific
+    # mnemonic), or a dialect of the isa, eg. 'short' or 'long'
+    def set_dialect(self, dialect):
+        self._load_tables()
+        if (dialect not in ('any', 'strict') and dialect not in self._tables['misc']):
+            raise MyException('Error: unknown dialect %s, one of: %s' % (dialect, ", ".join(['any', 'strict'] +
+                              sorted([d for d in self._tables['misc'] if (d != 'any')]))))
+        self._dialect = dialect
+
+    # set the lookup tables of the dialect, at the start of each pass
+    def _select_tables(self):
+        dialect = 'any' if (self._dialect == 'strict') else self._dialect
+        self._dialect_lock = '' if (self._dialect == 'strict') else dialect
+        self._lookup_dialect = dialect
+        self._lookup_misc = self._tables['misc'][dialect]
+        self._lookup_arith = self._tables['arith']
+        self._lookup_branch = self._tables['branch'][dialect]
+        if ('memo' not in self._tables):
+            from collections import OrderedDict
+            self._tables['memo'] = {'lines': OrderedDict(), 'hits': 0, 'misses': 0,
+                                    'prefixes': self._prefix_tree()}
+        self._memo = self._tables['memo']
+
+    # the token prefixes of all mnemonics as a tree {token: {token: ..}}, the decoding of
+    # a line depends only on its tokens found in the tree (see _decode())
+    def _prefix_tree(self):
+        tree = {}
+        for table in (self._tables['branch']['any'], self._tables['misc']['any'], self._tables['arith']):
+            for entries in table.values():
+                for entry in entries:
+                    node = tree
+                    for token in entry[0]:
+                        node = node.setdefault(token, {})
+        return tree
+
+    # the dialect and the leading tokens of ll (lowercase) found in the prefix tree
+    def _prefix(self, ll):
+        node = self._memo['prefixes']
+        key = [self._lookup_dialect]
+        for token in ll:
+            token = token.lower()
+            node = node.get(token)
+            if (node == None):
                 break
-        return (found, length,)
-    
+            key.append(token)
+        return tuple(key)
+
+    # strict dialect: the first dialect specific mnemonic selects the dialect
+    def _lock_dialect(self, dialect):
+        self._dialect_lock = dialect
+        self._lookup_dialect = dialect
+        self._lookup_misc = self._tables['misc'][dialect]
+        self._lookup_branch = self._tables['branch'][dialect]
+
+    # compile the opcode tables, or load them from the cache file (marshal) given by
+    # the environment variable ASM67_TABLE_CACHE, if set. Compiling takes about 1.2ms,
+    # loading the cache about 0.4ms, so the cache is opt-in, eg. for editor integrations
+    # running the assembler for each change. The cache is valid for this version of
+    # the source file
+    @classmethod
+    def _load_tables(cls):
+        if (cls._tables != None):
+            return
+        import os
+        key = None
+        path = os.path.expanduser(os.environ.get('ASM67_TABLE_CACHE', ''))
+        if (path != ''):
+            import marshal
+            try:
+                st = os.stat(__file__)
+                key = [cls._tables_version, marshal.version, st.st_mtime_ns, st.st_size]
+            except (NameError, OSError):
+                key = None
+        tables = None
+        if (key != None):
+            try:
+                f = open(path, 'rb')
+                data = marshal.loads(f.read())
+                f.close()
+                if (data[0] == key):
+                    tables = data[1]
+            except (OSError, EOFError, ValueError, TypeError, IndexError):
+                pass
+        if (tables == None):
+            tables = cls._compile_tables(cls.isa_definition())
+            if (key != None):
+                try:            # the cache is optional, eg. for a read-only install
+                    if (os.path.dirname(path) != ''):
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                    tmp = '%s.%d' % (path, os.getpid())
+                    f = open(tmp, 'wb')
+                    f.write(marshal.dumps([key, tables]))
+                    f.close()
+                    os.replace(tmp, path)
+                except OSError:
+                    pass
+        cls._tables = tables
+
+    # find the first entry of a compiled table matching the start of the line
+    # lo: the lower case tokens of the line. Returns the entry and its length
+    def _lookup(self, lo, table):
+        entries = table.get(lo[0])
+        if (entries != None):
+            for entry in entries:
+                length = len(entry[0])
+                if (lo[0:length] == entry[0]):
+                    return (entry, length,)
+        return (None, 0,)
+
     def _calc_code(self, col, line, klass):
         return col << 6 | line << 2 | klass
     
-    def _find_misc(self, ll):
-        found, length = self._match(ll, self._op_misc_0a)
-        if (found >= 0):
-            return (self._calc_code(found, 0, 0), length,)
-        found, length = self._match(ll, self._op_misc_0b)
-        if (found >= 0):
-            return (self._calc_code(found, 0, 0), length,)
-        found, length = self._match(ll, self._op_misc_1)
-        if (found >= 0):
-            return (self._calc_code(found, 1, 0), length,)
-        found, length = self._match(ll, self._op_misc_2a)
-        if (found >= 0):
-            return (self._calc_code(found, 2, 0), length,)
-        found, length = self._match(ll, self._op_misc_2b)
-        if (found >= 0):
-            return (self._calc_code(found, 2, 0), length,)
-        found, length = self._match(ll, self._op_misc_3)
-        if (found >= 0):
-            return (self._calc_code(found, 3, 0), length,)
-        found, length = self._match(ll, self._op_misc_4a)
-        if (found >= 0):
-            return (self._calc_code(found, 4, 0), length,)
-        found, length = self._match(ll, self._op_misc_4b)
-        if (found >= 0):
-            return (self._calc_code(found, 4, 0), length,)
-        found, length = self._match(ll, self._op_misc_5)
-        if (found >= 0):
-            self._ifthen = 1
-            return (self._calc_code(found, 5, 0), length,)
-        found, length = self._match(ll, self._op_misc_6)
-        if (found >= 0):
-            return (self._calc_code(found, 6, 0), length,)
-        found, length = self._match(ll, self._op_misc_7)
-        if (found >= 0):
-            self._ifthen = 1
-            return (self._calc_code(found, 7, 0), length,)
-        found, length = self._match(ll, self._op_misc_8)
-        if (found >= 0):
-            return (self._calc_code(found, 8, 0), length,)
-        found, length = self._match(ll, self._op_misc_9)
-        if (found >= 0):
-            self._ifthen = 1
-            return (self._calc_code(found, 9, 0), length,)
-        found, length = self._match(ll, self._op_misc_A1)
-        if (found >= 0):
-            return (self._calc_code(found, 10, 0), length,)
-        found, length = self._match(ll, self._op_misc_A2)
-        if (found >= 0):
-            return (self._calc_code(found, 10, 0), length,)
-        found, length = self._match(ll, self._op_misc_B)
-        if (found >= 0):
-            self._ifthen = 1
-            return (self._calc_code(found, 11, 0), length,)
-        found, length = self._match(ll, self._op_misc_E1)    # must do E2 before C1, else match on "c -> data"
-        if (found >= 0):
-            return (self._calc_code(found, 14, 0), length,)
-        found, length = self._match(ll, self._op_misc_E2)
-        if (found >= 0):
-            return (self._calc_code(found, 14, 0), length,)
-        found, length = self._match(ll, self._op_misc_C2)    # must do C2 before C1, else match on "c -> data"
-        if (found >= 0):
-            return (self._calc_code(found, 12, 0), length,)
-        found, length = self._match(ll, self._op_misc_C1)
-        if (found >= 0):
-            return (self._calc_code(found, 12, 0), length,)
-        found, length = self._match(ll, self._op_misc_D1)
-        if (found >= 0):
-            return (self._calc_code(found, 13, 0), length,)
-        found, length = self._match(ll, self._op_misc_D2)
-        if (found >= 0):
-            return (self._calc_code(found, 13, 0), length,)
-        found, length = self._match(ll, self._op_misc_F)
-        if (found >= 0):
-            return (self._calc_code(found, 15, 0), length,)
+    # decode the mnemonic of a line, the tokens ll:
+    # ('branch', kind, length, dialect), ('misc', code, length, ifthen, dialect),
+    # ('arith', code, length, cy, ifthen) or ('none',)
+    # The decoding does not depend on the labels or the address, the decoded lines are
+    # kept for all passes and assemblies of the process, per table set and dialect.
+    # The key is the lowercase tokens which start a mnemonic (see _prefix_tree()): the
+    # target of a branch and the comment are not part of it. The least recently used
+    # lines are dropped. The lines of an assembly are also kept as written (_decoded),
+    # for the next passes
+    def _decode(self, ll):
+        memo = self._memo
+        raw = (self._lookup_dialect, tuple(ll))
+        decoded = self._decoded.get(raw)
+        if (decoded != None):
+            memo['hits'] = memo['hits'] + 1
+            return decoded
+        lines = memo['lines']
+        key = self._prefix(ll)
+        if (len(ll) > 2 and ll[1] == "exchange"):      # also an arith mnemonic with "<->", see below
+            key = key + ('',) + self._prefix([ll[0], '<->'] + ll[2:])
+        decoded = lines.get(key)
+        if (decoded != None):
+            memo['hits'] = memo['hits'] + 1
+            lines.move_to_end(key)
+            self._decoded[raw] = decoded
+            return decoded
+        memo['misses'] = memo['misses'] + 1
+        lo = [token.lower() for token in ll]
+        entry, length = self._lookup(lo, self._lookup_branch)
+        if (entry != None):
+            decoded = ('branch', entry[1], length, entry[2])
+        else:
+            entry, length = self._lookup(lo, self._lookup_misc)
+            if (entry != None):
+                decoded = ('misc', entry[1], length, entry[2], entry[3])
+            else:
+                if (len(ll) > 2 and ll[1] == "exchange"):
+                    lo[1] = "<->"
+                entry, length = self._lookup(lo, self._lookup_arith)
+                if (entry != None):
+                    found = entry[1]
+                    decoded = ('arith', found << 5 | entry[2] << 2 | 0x002, length,
+                               self._op_arith_cy[found], (found >= 22) and (found <= 27))
+                else:
+                    decoded = ('none',)
+        while (len(lines) >= self._memo_size):
+            lines.popitem(last=False)
+        lines[key] = decoded
+        self._decoded[raw] = decoded
+        return decoded
+
+    # hits and misses of the decoded lines (see _decode()), for the tables in use
+    def memo_stats(self):
+        self._load_tables()
+        memo = self._tables.get('memo', {'lines': (), 'hits': 0, 'misses': 0})
+        total = memo['hits'] + memo['misses']
+        return {'hits': memo['hits'], 'misses': memo['misses'], 'lines': len(memo['lines']),
+                'size': self._memo_size, 'hit_rate': float(memo['hits']) / total if (total > 0) else 0.0}
+
+    def _find_misc(self, decoded):
+        if (decoded[0] == 'misc'):
+            if (self._dialect_lock == '' and decoded[4] != ''):
+                self._lock_dialect(decoded[4])
+            if (decoded[3]):
+                self._ifthen = 1
+            return (decoded[1], decoded[2],)
         return (-1, 0,)
 
-    def _find_arith(self, ll):
-        k = 0
-        for tef in self._op_tef:
-            arith = []
-            for op in self._op_arith:
-                arith.append(op % tef)
-            #print arith
-            if (len(ll) > 2 and ll[1] == "exchange"):
-                ll[1] = "<->"
-            found, length = self._match(ll, arith)
-            if (found >= 0):
-                self._cy = self._op_arith_cy[found]
-                if ((found >= 22) and (found <= 27)):
-                    self._ifthen = 1
-                return (found << 5 | k << 2 | 0x002, length,)
-            k = k + 1
+    def _find_arith(self, ll, decoded):
+        if (len(ll) > 2 and ll[1] == "exchange"):
+            ll[1] = "<->"
+        if (decoded[0] == 'arith'):
+            self._cy = decoded[3]
+            if (decoded[4]):
+                self._ifthen = 1
+            return (decoded[1], decoded[2],)
         return (-1, 0,)
         
     def _find_opcode(self, ll, passe, last):
-        found, length = self._match(ll, self._op_branch)
+        decoded = self._decode(ll)
+        found = decoded[1] if (decoded[0] == 'branch') else -1
+        if (found >= 0 and self._dialect_lock == '' and decoded[3] != ''):
+            self._lock_dialect(decoded[3])
         if (found >= 0):
+            length = decoded[2]
             if (found == 0):            # then go to
                 if (self._ifthen == 0):
-                    print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-                    raise MyException('Error: "then go to" - without if')
+                    self._error('then-without-if', '"then go to" - without if', " ".join(ll))
                 else:
                     self._ifthen = 0
                     if (passe == 0):  # pass 0
@@ -336,19 +647,22 @@ class HP67():
                             adr = self._find_label(ll[length])
                         if (last):
                             if (adr < 0):
-                                print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-                                raise MyException('Error: Label not found')
+                                self._error('label-not-found', 'Label not found', " ".join(ll))
                         code = adr - (self._pc & 0xC00)
+                        if ((code < 0 or code > 1023) and self._tramp and adr >= 0):
+                            stub = self._trampoline(adr, ll[length], self._pc & 0xC00, 0x400, ll, last)
+                            if (stub >= 0):
+                                return (stub - (self._pc & 0xC00), length + 1,)
+                            if (stub == -2):
+                                return (code & 0x3FF, length + 1,)
                         if ((code < 0) or (code > 1023)):
                             if (last):
-                                print("0x%x%03X: " % (self._bank, self._pc), " ".join(ll),
-                                      " [ dest=0x%X%03X (%d) ]" % (self._bank, adr, code))
-                                raise MyException('Error: "then go to" - too far')
+                                self._error('too-far', '"then go to" - too far', " ".join(ll) +
+                                            "  [ dest=0x%X%03X (%d) ]" % (self._bank, adr, code))
                         return (code, length + 1,)
             elif (found == 1 or found == 4):        # "if n/c go to"  or "if no carry go to"
                 if (self._cy == 0 and found == 1):  # only test for the "n/c" mnemonic  FIXME: use a switch?
-                    print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-                    raise MyException('Error: "if n/c go to" without CY operation')
+                    self._error('nc-without-cy', '"if n/c go to" without CY operation', " ".join(ll))
                 else:
                     self._cy = 0
                     if (passe == 0):   # pass 0
@@ -361,17 +675,22 @@ class HP67():
                             adr = self._find_label(ll[length])
                         if (last):
                             if (adr < 0):
-                                print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-                                raise MyException('Error: Label not found')
+                                self._error('label-not-found', 'Label not found', " ".join(ll))
                         dist = adr - (self._pc & 0xF00)
-                        if (last and self._del_rom_force == 0 and (self._pc & 0xFF) == 0xFF):
-                            print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-                            raise MyException('Error: "go to" not allowed on last word in ROM')
+                        lastword = (self._del_rom_force == 0 and (self._pc & 0xFF) == 0xFF)
+                        if ((lastword or dist < 0 or dist > 255) and self._tramp and adr >= 0):
+                            # on the last word the branch goes to the next rom
+                            stub = self._trampoline(adr, ll[length], (self._pc + lastword) & 0xF00, 0x100, ll, last)
+                            if (stub >= 0):
+                                return ((stub & 0xFF) << 2 | 0x003, length + 1,)
+                            if (stub == -2):
+                                return ((dist & 0xFF) << 2 | 0x003, length + 1,)
+                        if (last and lastword):
+                            self._error('last-word', '"go to" not allowed on last word in ROM', " ".join(ll))
                         if ((dist < 0) or (dist > 255)):
                             if (last):
-                                print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll),
-                                      " [ dest=0x%X%03X (%d) ]" % (self._bank, adr, dist))
-                                raise MyException('Error, "if n/c go to" - too far')
+                                self._error('too-far', '"if n/c go to" - too far', " ".join(ll) +
+                                            "  [ dest=0x%X%03X (%d) ]" % (self._bank, adr, dist))
                         code = dist << 2 | 0x003
                         return (code, length + 1,)
             elif ((found == 2) or (found == 3)):          # go to or jsb
@@ -415,24 +734,30 @@ class HP67():
                             adr = self._find_label(ll[length])
                         if (last):
                             if (adr < 0):
-                                print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-                                raise MyException('Error: Label not found')
+                                self._error('label-not-found', 'Label not found', " ".join(ll))
                         dist = adr - (self._pc & 0xF00)
                         #print(ll[length], adr, dist)
                         if (dist >= 0 and dist <= 255 and self._del_rom_force == 2):
                             # jsb/goto in same rom with "del sel rom auto"
                             self._del_rom_force = 0  # auto not needed
-                        if (last and self._del_rom_force == 0 and (self._pc & 0xFF) == 0xFF):
-                            print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-                            raise MyException('Error: "jsb/go to" not allowed on last word in ROM')
+                        lastword = (self._del_rom_force == 0 and (self._pc & 0xFF) == 0xFF)
+                        if (lastword and self._tramp and adr >= 0):
+                            if (dist >= 0 and dist <= 255):
+                                # a trampoline in the next rom, jsb returns after the last word
+                                stub = self._trampoline(adr, ll[length], (self._pc + 1) & 0xF00, 0x100, ll, last)
+                                if (stub >= 0):
+                                    return ((stub & 0xFF) << 2 | (0x001 if (found == 3) else 0x003), length + 1,)
+                                lastword = (stub == -1)
+                            else:
+                                lastword = 0    # the auto "del sel rom" moves the jump to the next rom
+                        if (last and lastword):
+                            self._error('last-word', '"jsb/go to" not allowed on last word in ROM', " ".join(ll))
                         if ((dist < 0) or (dist > 255)):  # jsb/goto to another rom?
                             if (self._del_rom_force == 1):
                                 if (last):
                                     if ((adr >> 8) != self._del_rom_force_rom):
-                                        print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll),
-                                              " [ select-rom: %x00 != %x, " % (self._del_rom_force_rom, adr & 0xf00),
-                                              "bank=%d" % self._bank, "]")
-                                        raise MyException('Error: manual "del sel rom" not on target')
+                                        self._error('del-sel-rom-target', 'manual "del sel rom" not on target', " ".join(ll) +
+                                                    "  [ select-rom: %x00 != %x,  bank=%d ]" % (self._del_rom_force_rom, adr & 0xf00, self._bank))
                             else:
                                 self._del_rom_emit = 1  # emit 'dly sel bank' before long go-todel_
                                 if (self._del_rom_force == 2):          # auto
@@ -440,7 +765,7 @@ class HP67():
                                 self._del_rom = (adr >> 8 ) << 6 | 0x034
                                 if (last and self._del_rom_force != 2):
                                     # do not emit info for 'del sel rom auto'
-                                    print('Info: Auto inserted "del sel rom %d" at 0x%X%03X:' % (adr >> 8, self._bank, self._pc), " ".join(ll))
+                                    self._note('info', 'auto-del-sel-rom', 'Auto inserted "del sel rom %d"' % (adr >> 8), " ".join(ll))
                             dist = adr & 0x0FF
                         if (found == 3):
                             code = dist << 2 | 0x001
@@ -450,37 +775,31 @@ class HP67():
                         return (code, length + 1,)
         else:
             self._del_rom_force = 0
-            code, length = self._find_misc(ll)
+            code, length = self._find_misc(decoded)
             if (code >= 0):
                 #print('  len=', length, " line=", " ".join(ll))
                 if (code == 0x230):                 # bank switch
                     if (last):
                         if (length >= len(ll)):
-                            print('0x%X%03X: ' % (self._bank, self._pc), " ".join(ll))
-                            print('Warning: "bank switch" missing label')
-                            #raise MyException('Warning: "bank switch" missing label')
+                            self._note('warning', 'bank-switch-label', '"bank switch" missing label', " ".join(ll))
                         elif (self._find_label(ll[length]) != (self._pc + 1)):
-                            print('0x%X%03X: ' % (self._bank, self._pc), " ".join(ll),
-                                  " [ target: 0x%04X != 0x%04X" % (self._find_label(ll[length]), self._pc+1), "]")
-                            raise MyException('Error: "bank switch" not on target')
+                            self._error('bank-switch-target', '"bank switch" not on target', " ".join(ll) +
+                                        "  [ target: 0x%04X != 0x%04X ]" % (self._find_label(ll[length]), self._pc+1))
                     length = length + 1
                 if ((code & 0x03F) == 0x020):       # sel rom
                     if (last):
                         dest = ((code >> 6) << 8) | (self._pc & 0x0FF) + 1
                         if (length >= len(ll)):
-                            print('0x%X%03X: ' % (self._bank, self._pc), " ".join(ll))
-                            print('Warning: "sel rom" missing label')
-                            #raise MyException('WARNING: "sel rom" missing label')
+                            self._note('warning', 'sel-rom-label', '"sel rom" missing label', " ".join(ll))
                         elif (self._find_label(ll[length]) != dest):
-                            print('0x%X%03X: ' % (self._bank, self._pc), " ".join(ll),
-                                  " [ target: 0x%04X != 0x%04X" % (self._find_label(ll[length]), dest), "]")
-                            raise MyException('Error: "sel rom" not on target')
+                            self._error('sel-rom-target', '"sel rom" not on target', " ".join(ll) +
+                                        "  [ target: 0x%04X != 0x%04X ]" % (self._find_label(ll[length]), dest))
                     # length = length + 1
                 if ((code & 0x03F) == 0x034):       # del sel rom
                     self._del_rom_force = 1
                     self._del_rom_force_rom = (code >> 6)
                 return (code, length,)
-            code, length = self._find_arith(ll)
+            code, length = self._find_arith(ll, decoded)
             if (code >= 0):
                 return (code, length,)
 
@@ -489,15 +808,14 @@ class HP67():
                 org = self._get_address(ll[1])
                 if ((self._bank == 0 and (org & 0x1000) != 0) or
                     (self._bank == 1 and (org & 0x1000) != 0x1000)):
-                    print('0x%X%03X: ' % (self._bank, (self._pc & 0xfff)), " ".join(ll))
-                    raise MyException('Error: org does not match bank')
+                    self._soft_error('org-bank', 'org does not match bank', " ".join(ll))
                 org = org & 0xfff
                 if (last):
+                    self._orgs.append(org | (self._bank << 12))
                     if (self._pc > org):
-                        print('0x%X%03X: ' % (self._bank, self._pc), " ".join(ll))
-                        raise MyException('Error: org base > current pc')
+                        self._soft_error('org-back', 'org base > current pc', " ".join(ll))
                     if (self._pc < org and not (self._bank == 1 and org == 0x400)):
-                        print("Info: Empty words (%d) before org 0x%X, bank=%d" % (org - self._pc, org, self._bank))
+                        self._note('info', 'empty-words', 'Empty words (%d) before org 0x%X, bank=%d' % (org - self._pc, org, self._bank))
                 self._pc = org
                 return (-1, 2,)
 
@@ -507,12 +825,13 @@ class HP67():
 
             elif ll[0] == 'public':                 # public label
                 if (last):
+                    adr = self._find_label(ll[1])
+                    if (adr >= 0):
+                        self._publics.append(adr | (self._bank << 12))
                     # write symbol to publics file (if defined)
                     if (self._pub != None):
-                        adr = self._find_label(ll[1])
                         if (adr < 0):
-                            print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-                            raise MyException('Error: Export label not found')
+                            self._soft_error('export-label', 'Export label not found', " ".join(ll))
                         else:
                             # NOTE: assume symbol is in the same bank as current PC
                             self._pub.write("#define %s 0x%X%03X\n" % (ll[1], self._bank, adr))
@@ -528,8 +847,13 @@ class HP67():
 
             else:
                 if (last):
-                    print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-                    raise MyException('Error: Bad opcode')
+                    lo = [token.lower() for token in ll]
+                    if (self._dialect_lock != 'any' and
+                        (self._lookup(lo, self._tables['misc']['any'])[0] != None or
+                         self._lookup(lo, self._tables['branch']['any'])[0] != None)):
+                        self._soft_error('dialect', 'opcode not in the %s dialect' % (self._dialect_lock), " ".join(ll))
+                    else:
+                        self._soft_error('bad-opcode', 'Bad opcode', " ".join(ll))
         return (-1, 0,)
 
     def _add_label(self, name, address):
@@ -537,17 +861,17 @@ class HP67():
         if (len(name) == 0):
             return
         if (name[-1] != ':'):   # labels must end with ':'
-            print('Label: %s = 0x%04x' % (name, address))
-            print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-            raise MyException('Error: Bad label, must end with :')
+            self._soft_error('bad-label', 'Bad label, must end with :', 'Label: %s = 0x%04x' % (name, address))
+            return
         name = name[:-1]        # strip colon
         if (name[0] != '.'):    # locals starts with '.'
             self._last_global = name
         else:
             name = self._last_global + name
         if name in self._labels.keys():
-            print("0x%X%03X: " % (self._bank, self._pc), "%s: [ %s = 0x%04X ]" % (name, name, self._labels[name]))
-            raise MyException('Error: label already defined')
+            self._dup_labels.add((self._line_no, name))
+            self._soft_error('label-defined', 'label already defined', "%s: [ %s = 0x%04X ]" % (name, name, self._labels[name]))
+            return
         self._labels[name] = address | (self._bank << 12)
     
     def _correct_label(self, name, address):
@@ -560,9 +884,11 @@ class HP67():
             self._last_global = name
         else:
             name = self._last_global + name
+        if ((self._line_no, name) in self._dup_labels):
+            return              # keep the first definition
         if name not in self._labels.keys():
-            print("0x%X%03X: " % (self._bank, self._pc), 'Label="%s"' % name)
-            raise MyException('Error: label not defined')
+            self._soft_error('label-undefined', 'label not defined', 'Label="%s"' % name)
+            return
         if (self._labels[name] != (address | (self._bank << 12))):
             self._delta_labels = 1
             self._labels[name] = address | (self._bank << 12)
@@ -570,14 +896,16 @@ class HP67():
     def _find_label(self, name):
         if (name[0] == '.'):
             name = self._last_global + name
+        if (self._refs != None):
+            self._refs.add(name)
         if name in self._labels.keys():
             return self._labels[name] & 0xFFF
         return -1
 
     def _add_define(self, name, value):
         if name in self._defines.keys():
-            print("0x%X%03X: " % (self._bank, self._pc), '#define', name, value)
-            raise MyException('Error: #define already defined')
+            self._soft_error('define-defined', '#define already defined', '#define %s %s' % (name, value))
+            return
         self._defines[name] = value
 
     def _find_define(self, name):
@@ -618,8 +946,7 @@ class HP67():
         if (len(ll) == 2 or (len(ll) >= 3 and (ll[2][0] == '#' or ll[2][0:2] == '//'))):
             result = (value1 > 0) # single argument (or single with a comment)
         elif (len(ll) == 3 and ll[2] != '#' and ll[2] != '//'):
-            print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-            raise MyException('Error: bad #if/#elif')
+            self._error('bad-if', 'bad #if/#elif', " ".join(ll))
         elif (len(ll) >= 4):
             value2 = self._find_number_or_define(ll[3])
             if ll[2] == '==':
@@ -639,8 +966,7 @@ class HP67():
             elif ll[2] == '||':
                 result = ((value1 | value2) > 0)
             else:
-                print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-                raise MyException('Error: bad #if/#elif expression')
+                self._error('bad-if', 'bad #if/#elif expression', " ".join(ll))
         return result
 
     # handle #if, #ifdef, #else, #endif, labels and comments
@@ -648,8 +974,7 @@ class HP67():
     def _handle_if_else_endif(self, ll):
         if ll[0] == '#define' and self._do_line:
             if (len(ll) < 3):
-                print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-                raise MyException('Error: bad #define')
+                self._error('bad-define', 'bad #define', " ".join(ll))
             self._add_define(ll[1], int(ll[2], 0))   # new define
             return 1, ''
 
@@ -680,8 +1005,7 @@ class HP67():
 
         elif ll[0] == '#else':
             if (len(self._do_line_stack) == 0):
-                print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-                raise MyException('Error: #else without #if/#ifdef')
+                self._error('else-without-if', '#else without #if/#ifdef', " ".join(ll))
             if (not self._do_line_skip_elses and self._do_line_stack[0][0]):
                 # don't skip elses -> this one will be active, if previous state is enabled
                 self._do_line = True
@@ -692,8 +1016,7 @@ class HP67():
 
         elif ll[0] == '#elif':
             if (len(self._do_line_stack) == 0):
-                print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-                raise MyException('Error: #elif without #if')
+                self._error('elif-without-if', '#elif without #if', " ".join(ll))
             if (not self._do_line_skip_elses and self._do_line_stack[0][0]):
                 # don't skip elses -> this one should be evaluated, if previous state is enabled
                 self._do_line = self._eval_expression(ll)
@@ -706,20 +1029,17 @@ class HP67():
 
         elif ll[0] == '#endif':
             if (len(self._do_line_stack) == 0):
-                print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-                raise MyException('Error: #endif without #if/#ifdef')
+                self._error('endif-without-if', '#endif without #if/#ifdef', " ".join(ll))
             self._do_line, self._do_line_skip_elses = self._do_line_stack.pop(0) # restore state
             self._cur_define = ''
             # print("#endif, lvl=", len(self._do_line_stack))
             return 0, ''
 
         elif ll[0] == '#error' and self._do_line:
-            print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-            raise MyException('Error: stop at #error')
+            self._error('error-directive', 'stop at #error', " ".join(ll))
 
         elif ll[0][0] == '#' and self._do_line:
-            print("0x%X%03X: " % (self._bank, self._pc), " ".join(ll))
-            raise MyException('Error: bad directive')
+            self._error('bad-directive', 'bad directive', " ".join(ll))
 
         # no define, then it's a label, or a comment
         label = ''
@@ -729,6 +1049,770 @@ class HP67():
                 ll.pop(0)            # remove from line
         return 0, label
 
+    # define a macro, local labels in the body are made unique per invocation
+    def _add_macro(self, name, params, body):
+        if name in self._macros.keys():
+            self._soft_error('macro-defined', '#macro already defined', '#macro ' + name)
+            return
+        local = []
+        for line in body:
+            ll = line.split()
+            if (line[0] > ' ' and len(ll) > 0 and ll[0][0] == '.' and ll[0][-1] == ':'):
+                local.append(ll[0][:-1])
+        if (len(local) > 0):
+            import re
+            new_body = []
+            for line in body:
+                parts = re.split(r'(\s+)', line)
+                for i in range(len(parts)):
+                    if parts[i] in local:
+                        parts[i] = parts[i] + '@\\@'
+                    elif (parts[i][-1:] == ':' and parts[i][:-1] in local):
+                        parts[i] = parts[i][:-1] + '@\\@:'
+                new_body.append("".join(parts))
+            body = new_body
+        self._macros[name] = (params, body, self._macro_pos)
+
+    # expand a macro invocation, the result is memoized by (name, args)
+    def _expand_macro(self, name, args):
+        key = (name, tuple(args))
+        if key not in self._macro_memo.keys():
+            params, body, pos = self._macros[name]
+            if (len(args) != len(params)):
+                self._soft_error('macro-args', 'macro argument count mismatch', " ".join([name] + args))
+                return []
+            values = dict(zip(params, args))
+            params = sorted(params, key=len, reverse=True)  # substitute \ab before \a
+            expansion = []
+            for line in body:
+                for param in params:
+                    line = line.replace('\\' + param, values[param])
+                expansion.append((line, '\\@' in line))
+            self._macro_memo[key] = expansion
+        n = str(self._macro_count)
+        self._macro_count = self._macro_count + 1
+        return [line.replace('\\@', n) if unique else line for line, unique in self._macro_memo[key]]
+
+    # handle #macro/#endm definitions and macro invocations
+    # yields: source line, and raw (1: list only, do not assemble)
+    # a macro is only expanded after its definition, the same in all passes
+    def _expand_macros(self, lines, depth=0):
+        name = None
+        if (depth == 0):
+            self._macro_pos = 0
+        for n, line in enumerate(lines, 1):
+            if (depth == 0):
+                self._line_no = n
+            self._macro_pos = self._macro_pos + 1
+            ll = line.split()
+            if (name != None):                      # inside a #macro body
+                if (len(ll) > 0 and line[0] > ' ' and ll[0] == '#endm'):
+                    if (self._pass == 0 and define):
+                        self._add_macro(name, params, body)
+                    name = None
+                elif (len(ll) > 0 and line[0] > ' ' and ll[0] == '#macro'):
+                    self._soft_error('nested-macro', 'nested #macro', " ".join(ll))
+                else:
+                    body.append(line)
+                yield line, 1
+                continue
+            if (len(ll) == 0):
+                yield line, 0
+                continue
+            if (line[0] > ' ' and ll[0] == '#macro'):
+                params = []
+                for token in ll[1:]:
+                    if (token[0] == '#' or token[0:2] == '//'):
+                        break
+                    params.append(token)
+                if (len(params) == 0):
+                    self._soft_error('bad-macro', 'bad #macro', " ".join(ll))
+                    params = ['']       # skip the body
+                name = params.pop(0)
+                define = self._do_line and name != ''  # body is always skipped, only defined if active
+                body = []
+                yield line, 1
+                continue
+            if (line[0] > ' ' and ll[0] == '#endm'):
+                self._soft_error('endm-without-macro', '#endm without #macro', " ".join(ll))
+                yield line, 1
+                continue
+            label = ''
+            if (line[0] > ' ' and ll[0][-1] == ':' and len(ll) > 1):
+                label = ll.pop(0)                   # label before a macro invocation
+            if (not self._do_line or ll[0] not in self._macros.keys() or
+                (line[0] > ' ' and label == '')):
+                yield line, 0
+                continue
+            if (self._macros[ll[0]][2] > self._macro_pos):
+                self._soft_error('macro-before-definition', 'macro used before definition', " ".join(ll))
+                yield line, 1
+                continue
+            if (depth >= 16):
+                self._soft_error('macro-depth', 'macro nesting too deep', " ".join(ll))
+                yield line, 1
+                continue
+            args = []
+            for token in ll[1:]:
+                if (token[0] == '#' or token[0:2] == '//'):
+                    break
+                args.append(token)
+            yield line, 1                           # list the invocation
+            if (label != ''):
+                yield label + '\n', 0
+            yield from self._expand_macros(self._expand_macro(ll[0], args), depth + 1)
+        if (name != None):
+            self._soft_error('macro-without-endm', '#macro without #endm', '#macro ' + name)
+
+    # store a word in the rom image, each address can only be written once
+    def _put(self, adr, code, opcode):
+        if (self._used[adr]):
+            self._soft_error('overlap', 'overlapping code, 0x%04X already used' % adr, opcode.rstrip())
+        self._used[adr] = 1
+        self._rom[adr] = code
+
+    # rom utilization from the occupancy bitmap, per bank and per rom (256 words):
+    # used and free words, and the free runs [start, length], largest first
+    def usage(self):
+        banks = []
+        for bank in range(2):
+            roms = []
+            for rom in range(16):
+                base = (bank << 12) | (rom << 8)
+                runs = []
+                i = self._used.find(0, base, base + 256)
+                while (i >= 0):
+                    end = self._used.find(1, i, base + 256)
+                    if (end < 0):
+                        end = base + 256
+                    runs.append([i, end - i])
+                    i = self._used.find(0, end, base + 256)
+                runs.sort(key=lambda r: r[1], reverse=True)
+                used = self._used.count(1, base, base + 256)
+                roms.append({'rom': rom, 'address': base, 'used': used, 'free': 256 - used,
+                             'free_runs': runs})
+            used = sum([r['used'] for r in roms])
+            largest = max([r['free_runs'][0] for r in roms if len(r['free_runs']) > 0],
+                          key=lambda r: r[1], default=[bank << 12, 0])
+            banks.append({'bank': bank, 'used': used, 'free': 4096 - used,
+                          'largest_free': largest, 'roms': roms})
+        return banks
+
+    # print the utilization report, or write it as json to file_usage
+    def _report_usage(self, usage, file_usage):
+        banks = self.usage()
+        if (usage == 'json'):
+            import json
+            f = open(file_usage, 'wt')
+            json.dump(banks, f, indent=1)
+            f.write('\n')
+            f.close()
+            return
+        print('ROM usage:           used  free  largest free')
+        for b in banks:
+            print(' bank %d              %4d  %4d  0x%04X (%d)' % (b['bank'], b['used'], b['free'],
+                                                               b['largest_free'][0], b['largest_free'][1]))
+            for r in b['roms']:
+                if (len(r['free_runs']) > 0):
+                    largest = '0x%04X (%d)' % (r['free_runs'][0][0], r['free_runs'][0][1])
+                else:
+                    largest = '-'
+                print('  rom %X 0x%04X-0x%04X %4d  %4d  %s' % (r['rom'], r['address'], r['address'] + 255,
+                                                             r['used'], r['free'], largest))
+
+    # 1: the word w is a test, the next word is the address of a "then go to":
+    # if S/p .. (misc rows 5, 7, 9, 11) or if a/b/c .. (arith 22..27)
+    def _is_test(self, w):
+        if (w & 3 == 0):
+            return ((w >> 2) & 0xF) in (5, 7, 9, 11)
+        return (w & 3 == 2 and 22 <= (w >> 5) <= 27)
+
+    # 1: the word at adr (with bank) is an instruction, not the address word of a "then go to"
+    def _is_instruction(self, adr):
+        prev = (adr & 0x1000) | ((adr - 1) & 0xFFF)
+        return self._used[adr] and not (self._used[prev] and self._is_test(self._rom[prev]))
+
+    # successors of the instruction at adr (with bank) in the rom image:
+    # returns (next addresses, 'then go to' address word or -1, 1: "keys/a -> rom address")
+    def _successors(self, adr):
+        rom = self._rom
+        w = rom[adr]
+        bank = adr & 0x1000
+        nxt = bank | ((adr + 1) & 0xFFF)
+        if (w & 3 == 0):                            # misc
+            row = (w >> 2) & 0xF
+            if (row in (5, 7, 9, 11)):              # if S/p ..
+                return ([bank | (((nxt & 0xC00) + rom[nxt]) & 0xFFF), bank | ((adr + 2) & 0xFFF)], nxt, 0)
+            if (w == 0x210):                        # return
+                return ([], -1, 0)
+            if (w == 0x010 or w == 0x090):          # keys -> rom address, a -> rom address
+                return ([], -1, 1)
+            if (row == 8):                          # sel rom
+                return ([bank | (w >> 6) << 8 | (nxt & 0xFF)], -1, 0)
+            if (w == 0x230):                        # bank switch
+                return ([nxt, nxt ^ 0x1000], -1, 0)
+            return ([nxt], -1, 0)
+        if (w & 3 == 2):                            # arith
+            if (22 <= (w >> 5) <= 27):              # if a/b/c ..
+                return ([bank | (((nxt & 0xC00) + rom[nxt]) & 0xFFF), bank | ((adr + 2) & 0xFFF)], nxt, 0)
+            return ([nxt], -1, 0)
+        # go to, if n/c go to or jsb, a "del sel rom" just before selects the target rom
+        prev = bank | ((adr - 1) & 0xFFF)
+        target = (nxt & 0x1F00) | (w >> 2)        # the rom of the next word, see _trampoline()
+        if (self._is_instruction(prev) and rom[prev] & 0x3F == 0x034):
+            target = bank | (rom[prev] >> 6) << 8 | (w >> 2)
+            prev = bank | ((adr - 2) & 0xFFF)
+        if (w & 3 == 1):                            # jsb, continues after the return
+            return ([target, nxt], -1, 0)
+        if (self._is_instruction(prev) and rom[prev] & 3 == 2 and self._op_arith_cy[rom[prev] >> 5]):
+            return ([target, nxt], -1, 0)           # "if n/c go to" after a carry operation
+        return ([target], -1, 0)
+
+    # reachability of the assembled code from the reset vector (0x0000), the public
+    # symbols and the labels and org addresses of a rom with "keys -> rom address"
+    # (dispatch table). Each word is visited once.
+    # returns the number of reachable words, the unreachable runs [start, length],
+    # per rom the used and unreachable words, and the never referenced labels
+    # not with only: the words outside the ranges are not encoded
+    def reachability(self):
+        if (self._only != None):
+            raise MyException('Error: no reachability with only, the image is partial')
+        reach = bytearray(8192)     # 1: instruction, 2: "then go to" address word
+        dispatch = []
+        work = [0x0000] + list(self._publics)
+        done_roms = set()
+        while (len(work) > 0):
+            adr = work.pop()
+            if (reach[adr] == 1 or not self._used[adr]):
+                continue
+            reach[adr] = 1
+            succ, then_word, table = self._successors(adr)
+            if (then_word >= 0 and reach[then_word] == 0 and self._used[then_word]):
+                reach[then_word] = 2
+            if (table and (adr >> 8) not in done_roms):
+                done_roms.add(adr >> 8)
+                dispatch.append(adr)
+                for a in list(self._labels.values()) + self._orgs:
+                    if ((a >> 8) == (adr >> 8)):
+                        work.append(a)
+            work.extend(succ)
+
+        runs = []
+        dead = 32 * [0]
+        i = 0
+        while (i < 8192):
+            if (self._used[i] and not reach[i]):
+                start = i
+                while (i < 8192 and self._used[i] and not reach[i]):
+                    dead[i >> 8] = dead[i >> 8] + 1
+                    i = i + 1
+                runs.append([start, i - start])
+            else:
+                i = i + 1
+        roms = []
+        for r in range(32):
+            used = self._used.count(1, r << 8, (r + 1) << 8)
+            if (used > 0):
+                roms.append({'bank': r >> 4, 'rom': r & 0xF, 'address': r << 8, 'used': used, 'unreachable': dead[r]})
+        labels = sorted([[name, adr] for name, adr in self._labels.items()
+                         if (name not in self._refs and adr not in self._publics)], key=lambda l: l[1])
+        return {'reachable': 8192 - reach.count(0), 'unreachable': sum([r[1] for r in runs]),
+                'runs': runs, 'roms': roms, 'dispatch': dispatch, 'unused_labels': labels}
+
+    # print the reachability report, or write it as json to file_reach
+    def _report_reach(self, mode, file_reach):
+        result = self.reachability()
+        if (mode == 'json'):
+            import json
+            f = open(file_reach, 'wt')
+            json.dump(result, f, indent=1)
+            f.write('\n')
+            f.close()
+            return
+        print('Reachability: %d reachable, %d unreachable word(s)' % (result['reachable'], result['unreachable']))
+        for adr in result['dispatch']:
+            print(' dispatch table: keys/a -> rom address at 0x%04X' % adr)
+        for start, length in result['runs']:
+            print(' unreachable 0x%04X-0x%04X (%d)' % (start, start + length - 1, length))
+        for r in result['roms']:
+            if (r['unreachable'] > 0):
+                print('  rom %X 0x%04X-0x%04X used %4d  unreachable %4d' % (r['rom'], r['address'], r['address'] + 255,
+                                                                         r['used'], r['unreachable']))
+        for name, adr in result['unused_labels']:
+            print(' unused label 0x%04X %s' % (adr, name))
+
+    # branch of an instruction record: (found, operand index, full label name, target address),
+    # found is the index in _op_branch or -1, the name and target are None and -1 if unknown
+    def _branch_of(self, rec):
+        toks = rec[3]
+        if (len(toks) < 2):
+            return (-1, None, None, -1)
+        entry, length = self._lookup([t.lower() for t in toks], self._lookup_branch)
+        if (entry == None or length >= len(toks) or toks[length][0] == '$'):
+            return (-1, None, None, -1)
+        name = toks[length]
+        if (name[0] == '.'):
+            name = rec[7] + name
+        return (entry[1], length, name, self._labels.get(name, -1))
+
+    # words which keep the p register: arith (not if ..), S flags, data registers and nop
+    def _keeps_p(self, w):
+        if (w & 3 == 2):
+            return not (22 <= (w >> 5) <= 27)
+        return (w == 0x000 or (w & 3 == 0 and ((w >> 2) & 0xF) in (1, 3, 10, 14)))
+
+    # rewrite source line n to op (a removed line if op is ''), the note is shown in the listing
+    def _add_rewrite(self, n, line, op, note, kind, cycles):
+        if (n in self._opt_dropped):
+            return 0
+        kinds = []
+        if (n in self._rewrites):
+            note = self._rewrites[n][1] + ', ' + note
+            kinds = self._rewrites[n][2]
+        if (op == ''):
+            text = '        // -O: %s\n' % (note)
+        else:
+            head = line.split()[0] if (line[0] > ' ') else ''  # keep the label
+            text = '%s%s  // -O: %s\n' % ((head + ' ').ljust(8) if (head != '') else 8*' ', op, note)
+        if (n in self._rewrites and self._rewrites[n][0].split('//')[0] == text.split('//')[0]):
+            return 0
+        self._rewrites[n] = (text, note, kinds + [(kind, cycles)])
+        if (kind != None):
+            self._opt_stats[kind] = self._opt_stats[kind] + 1
+        self._opt_stats['cycles'] = self._opt_stats['cycles'] + cycles
+        return 1
+
+    # drop the rewrite of line n (and the other line of a tail call), it is not rewritten again
+    def _drop_rewrite(self, n):
+        text, note, kinds = self._rewrites.pop(n)
+        self._opt_dropped.add(n)
+        for kind, cycles in kinds:
+            if (kind != None):
+                self._opt_stats[kind] = self._opt_stats[kind] - 1
+            self._opt_stats['cycles'] = self._opt_stats['cycles'] - cycles
+        other = self._opt_pairs.pop(n, None)
+        if (other in self._rewrites):
+            self._drop_rewrite(other)
+
+    # report a note of the optimizer at the line of record rec
+    def _opt_note(self, rec, severity, code, message):
+        saved = (self._line_no, self._pc, self._bank)
+        self._line_no, self._pc, self._bank = rec[9], rec[1] & 0xFFF, rec[1] >> 12
+        self._note(severity, code, message, " ".join(rec[3]))
+        self._line_no, self._pc, self._bank = saved
+
+    # 1: the line of record rec may be removed, not if it moves the code of a rom with a
+    # "$" branch target or a rom address dispatch (reported once)
+    def _removable(self, rec):
+        if (rec[0] in self._opt_dropped):
+            return 0
+        fix = self._opt_fixed.get(rec[0], -1)
+        if (fix < 0):
+            return 1
+        if (rec[0] not in self._opt_warned):
+            self._opt_warned.add(rec[0])
+            self._opt_note(rec, 'warning', 'opt-fixed', '-O: not removed, the code of a "$" branch, rom ' +
+                           'address dispatch, sel rom or bank switch at 0x%04X would move' % fix)
+        return 0
+
+    # a "sel rom" or "bank switch" record: (the address its label must have, the label
+    # address or -1), None for other records
+    def _select_of(self, rec):
+        words = rec[4]
+        if (len(words) != 1 or rec[6] or not (words[0] & 0x3F == 0x020 or words[0] == 0x230)):
+            return None
+        adr = rec[1] & 0xFFF
+        toks = rec[3]
+        if (words[0] == 0x230):         # bank switch, the label is an operand
+            need = adr + 1
+            name = toks[-1] if (len(toks) > 2) else ''
+        else:                           # sel rom, the label follows the mnemonic
+            need = ((words[0] >> 6) << 8) | ((adr & 0xFF) + 1)
+            ll = rec[8].split()
+            name = ''
+            for i in range(len(ll) - len(toks)):
+                if (ll[i:i + len(toks)] == list(toks)):
+                    name = ll[i + len(toks)]
+                    break
+        if (name[0:1] == '.'):
+            name = rec[7] + name
+        return (need, self._labels.get(name, -1))
+
+    # the lines which must not be removed: they move the code of a rom with a "$" branch
+    # target, a "keys/a -> rom address" dispatch (the 1k block of a "then go to $"), or
+    # a "sel rom" or "bank switch" (and the rom of its label), the target addresses are
+    # fixed. Returns line: address of the "$" branch, dispatch, sel rom or bank switch
+    def _fixed_lines(self, recs):
+        pages = {}
+        for i in range(len(recs)):
+            n, adr, lab, toks, words = recs[i][0:5]
+            if ((words == (0x010,) or words == (0x090,)) and not recs[i][6]):   # keys/a -> rom address
+                pages.setdefault(adr >> 8, adr)
+                continue
+            sel = self._select_of(recs[i])
+            if (sel != None):
+                pages.setdefault(adr >> 8, adr)
+                if (sel[1] >= 0):
+                    pages.setdefault(sel[1] >> 8, adr)
+                continue
+            if (len(toks) < 2 or toks[-1][0] != '$'):
+                continue
+            entry, length = self._lookup([t.lower() for t in toks], self._lookup_branch)
+            if (entry == None or length >= len(toks)):
+                continue
+            b = adr + len(words) - 1
+            prev = recs[i - 1] if (i > 0 and recs[i - 1][1] + len(recs[i - 1][4]) == adr) else None
+            if (entry[1] == 0):
+                for rom in range(4):
+                    pages.setdefault(((b & 0x1C00) >> 8) | rom, adr)
+            elif (prev != None and len(prev[4]) == 1 and prev[4][0] & 0x3F == 0x034 and not prev[6]):
+                pages.setdefault(((b & 0x1000) >> 8) | (prev[4][0] >> 6), adr)
+            else:
+                pages.setdefault(b >> 8, adr)
+        fixed = {}
+        start = 0
+        for i in range(1, len(recs) + 1):
+            if (i < len(recs) and recs[i][1] == recs[i - 1][1] + len(recs[i - 1][4])):
+                continue
+            limit = -1                  # a run of words start..i-1, a removal moves the words after it
+            for k in range(start, i):
+                if ((recs[k][1] >> 8) in pages):
+                    limit, fix = recs[k][1], pages[recs[k][1] >> 8]
+            for k in range(start, i):
+                if (recs[k][1] <= limit):
+                    fixed[recs[k][0]] = fix
+            start = i
+        return fixed
+
+    # 1: the branch of record rec (found: kind) to target passes the range and last word
+    # checks of _find_opcode() at its address, prev: the record of the word before or None
+    def _reaches(self, found, rec, prev, target):
+        adr = rec[1] & 0xFFF
+        target = target & 0xFFF
+        if (found == 0):            # then go to: the 1k block
+            return (target & 0xC00) == (adr & 0xC00)
+        if (found == 1 or found == 4):
+            return (target >> 8) == (adr >> 8) and (adr & 0xFF) != 0xFF
+        if (prev != None and len(prev[4]) == 1 and prev[4][0] & 0x3F == 0x034 and not prev[6]):
+            return (target >> 8) in (adr >> 8, prev[4][0] >> 6)
+        if (prev != None and prev[3][0:4] == ['delayed', 'select', 'rom', 'auto']):
+            return (target >> 8) != (adr >> 8) or (adr & 0xFF) != 0xFF
+        return (adr & 0xFF) != 0xFF
+
+    # the lines of the branches which fail the range or last word checks in this layout,
+    # and of the "sel rom" and "bank switch" not on their label
+    def _failing(self, recs):
+        bad = set()
+        for i in range(len(recs)):
+            sel = self._select_of(recs[i])
+            if (sel != None and sel[1] >= 0 and (sel[1] & 0xFFF) != sel[0]):
+                bad.add(recs[i][0])
+            found, length, name, target = self._branch_of(recs[i])
+            if (found < 0 or target < 0):
+                continue
+            prev = recs[i - 1] if (i > 0 and recs[i - 1][1] + len(recs[i - 1][4]) == recs[i][1]) else None
+            if (not self._reaches(found, recs[i], prev, target)):
+                bad.add(recs[i][0])
+        return bad
+
+    # drop the rewrites which moved the branches of the lines bad (or their targets) out of
+    # range: the jump chain of the branch, else the nearest removed line before the branch
+    # or the target in its run of words, else all rewrites. Returns the number dropped
+    def _rollback(self, recs, at, bad):
+        if (len(bad) == 0):
+            return 0
+        run = []
+        for i in range(len(recs)):
+            if (i == 0 or recs[i][1] != recs[i - 1][1] + len(recs[i - 1][4])):
+                run.append(i)
+            else:
+                run.append(run[i - 1])
+        index = {}
+        for i in range(len(recs)):
+            index[recs[i][0]] = i
+        removed = sorted([n for n in self._rewrites if (n not in index)])
+        dropped = 0
+        for nb in sorted(bad):
+            i = index[nb]
+            found, length, name, target = self._branch_of(recs[i])
+            if (found < 0):
+                target = self._select_of(recs[i])[1]
+            self._opt_note(recs[i], 'info', 'opt-rollback', '-O: rewrite dropped, the branch to ' +
+                           '0x%04X would fail' % target)
+            if (nb in self._rewrites):
+                self._drop_rewrite(nb)
+                dropped = dropped + 1
+                continue
+            ends = [(run[i], nb)]
+            if (at.get(target) != None):
+                ends.append((run[at[target]], recs[at[target]][0]))
+            best = -1
+            for nr in removed:
+                k = 0                   # the next record: a removed line moves its run
+                while (k < len(recs) and recs[k][0] < nr):
+                    k = k + 1
+                for r, end in ends:
+                    if (k < len(recs) and run[k] == r and nr < end and nr in self._rewrites):
+                        best = max(best, nr)
+            if (best >= 0):
+                self._drop_rewrite(best)
+                dropped = dropped + 1
+        if (dropped == 0):
+            for n in list(self._rewrites):
+                if (n in self._rewrites):
+                    self._drop_rewrite(n)
+                    dropped = dropped + 1
+        return dropped
+
+    # peephole optimizer (-O) on the instruction records of a pass with stable labels:
+    # (line index, address, labelled, tokens, words, cy, ifthen, last global label, line,
+    # source line number), ifthen: the line after a test, its word is the address of a "then go to"
+    # - "jsb X" + "return" -> "go to X"
+    # - a branch to a "go to" (chain) -> a branch to the final target, if in range
+    # - "del sel rom" of the current rom before a go to/jsb in the same rom is removed
+    # - a repeated "n -> p" without a change of p in between is removed
+    # nothing is removed from a labelled line, after an "if", or after a carry operation
+    # (a following "if n/c go to"), or before a "$" branch target or rom address dispatch.
+    # A rewrite which moves a branch out of range is dropped (rollback).
+    # Returns the number of new and dropped rewrites, max 8 rounds
+    def _peephole(self, info):
+        stats = self._opt_stats
+        stats['size'] = sum([len(r[4]) for r in info])
+        recs = []
+        labelled = False
+        for r in info:
+            if (len(r[3]) == 0):        # label only line, the label is on the next instruction
+                labelled = True
+                continue
+            if (labelled):
+                r = r[0:2] + (True,) + r[3:]
+                labelled = False
+            recs.append(r)
+        at = {}
+        for i in range(len(recs)):
+            if (len(recs[i][4]) > 0 and recs[i][1] not in at):
+                at[recs[i][1]] = i
+        if (stats['words'] < 0):        # the layout without rewrites
+            stats['words'] = stats['size']
+            self._opt_base = self._failing(recs)
+            self._opt_fixed = self._fixed_lines(recs)
+        else:
+            dropped = self._rollback(recs, at, self._failing(recs) - self._opt_base)
+            if (dropped > 0):
+                return dropped
+        if (stats['rounds'] >= 8):
+            return 0
+        stats['rounds'] = stats['rounds'] + 1
+
+        new = 0
+        done = set()
+        p_val = -1
+        for i in range(len(recs)):
+            n, adr, lab, toks, words, cy, ifthen, glob, line, line_no = recs[i]
+            if (n in done):
+                continue
+            nxt = None
+            if (i + 1 < len(recs) and recs[i + 1][1] == adr + len(words) and not recs[i + 1][2]):
+                nxt = recs[i + 1]       # the next word, not a branch target
+            prev = None
+            if (i > 0 and recs[i - 1][1] + len(recs[i - 1][4]) == adr):
+                prev = recs[i - 1]
+            prev_dsr = (prev != None and len(prev[4]) == 1 and prev[4][0] & 0x3F == 0x034 and not prev[6])
+            found, length, name, target = self._branch_of(recs[i])
+
+            # tail call
+            if (found == 3 and cy == 0 and ifthen == 0 and nxt != None and nxt[4] == (0x210,) and
+                n not in self._opt_dropped and self._removable(nxt)):
+                new = new + self._add_rewrite(n, line, 'go to ' + toks[length], 'jsb + return', 'tail-call', 1)
+                new = new + self._add_rewrite(nxt[0], nxt[8], '', 'return removed', None, 0)
+                self._opt_pairs[n] = nxt[0]
+                self._opt_pairs[nxt[0]] = n
+                done.add(nxt[0])
+                p_val = -1
+                continue
+
+            # jump chain, a go to at the target is taken: no carry after a branch
+            if (found >= 0 and target >= 0 and not prev_dsr):
+                final = -1
+                seen = set([adr, target])
+                j = at.get(target)
+                hops = 0
+                while (j != None and hops < 16):
+                    rj = recs[j]
+                    fj, oj, nj, tj = self._branch_of(rj)
+                    if (fj not in (1, 2, 4) or len(rj[4]) != 1 or tj < 0 or tj in seen or nj[0] == '.'):
+                        break
+                    if (j > 0 and recs[j - 1][1] + len(recs[j - 1][4]) == rj[1] and len(recs[j - 1][4]) > 0 and
+                        recs[j - 1][4][-1] & 0x3F == 0x034 and not recs[j - 1][6]):
+                        break           # the go to has its own "del sel rom"
+                    seen.add(tj)
+                    final, final_name = tj, nj
+                    hops = hops + 1
+                    j = at.get(tj)
+                if (final >= 0):
+                    if (found == 0):        # then go to: same 1k
+                        ok = (final & 0x1C00) == (adr & 0x1C00)
+                    elif (found == 1 or found == 4):
+                        ok = (final >> 8) == (adr >> 8)
+                    elif (len(words) == 2 or (prev != None and prev[3][0:4] == ['delayed', 'select', 'rom', 'auto'])):
+                        ok = (final & 0x1000) == (adr & 0x1000)
+                    else:
+                        ok = (final >> 8) == (adr >> 8)
+                    if (ok):
+                        new = new + self._add_rewrite(n, line, " ".join(toks[0:length]) + ' ' + final_name,
+                                                      '%s -> %s' % (toks[length], final_name), 'jump-chain', hops)
+
+            # del sel rom of the current rom, the go to/jsb is in the same rom
+            if (len(words) == 1 and words[0] & 0x3F == 0x034 and (words[0] >> 6) == ((adr >> 8) & 0xF) and
+                not lab and cy == 0 and ifthen == 0 and nxt != None and len(nxt[4]) == 1):
+                fn, on, nn, tn = self._branch_of(nxt)
+                if ((fn == 2 or fn == 3) and tn >= 0 and (tn >> 8) == (adr >> 8) == (nxt[1] >> 8) and
+                    self._removable(recs[i])):
+                    new = new + self._add_rewrite(n, line, '', " ".join(toks) + ' removed', 'del-sel-rom', 1)
+                    done.add(n)
+                    p_val = -1
+                    continue
+
+            # repeated n -> p
+            if (lab):
+                p_val = -1
+            if (len(words) == 1 and words[0] & 0x3F == 0x03C and ifthen == 0):
+                if (words[0] == p_val and not lab and cy == 0 and ifthen == 0 and self._removable(recs[i])):
+                    new = new + self._add_rewrite(n, line, '', " ".join(toks) + ' removed', 'n-p', 1)
+                    done.add(n)
+                p_val = words[0]
+            elif (len(words) != 1 or ifthen or not self._keeps_p(words[0])):
+                p_val = -1
+        return new
+
+    # the optimizer result: rewrites per kind, the words saved and the cycles saved
+    # (each rewritten line executed once), size: words after the optimization
+    def opt_stats(self):
+        stats = dict(self._opt_stats)
+        stats['words'] = stats['words'] - stats['size'] if (stats['words'] >= 0) else 0
+        stats['rewrites'] = len(self._rewrites)
+        return stats
+
+    # print the optimizer report
+    def _report_opt(self):
+        stats = self.opt_stats()
+        print('Optimizer: %d line(s) rewritten, %d word(s) and %d cycle(s) saved' %
+              (stats['rewrites'], stats['words'], stats['cycles']))
+        print(' tail calls (jsb + return):  %d' % stats['tail-call'])
+        print(' jump chains:                %d' % stats['jump-chain'])
+        print(' del sel rom removed:        %d' % stats['del-sel-rom'])
+        print(' n -> p removed:             %d' % stats['n-p'])
+
+    # the trampoline of the branch at the current address to adr, in the window first ..
+    # first + size - 1 (in the bank). Returns its address, -2: a trampoline is requested,
+    # it is placed at the end of the pass (see _place_trampolines()), -1: no room for it
+    def _trampoline(self, adr, name, first, size, ll, last):
+        bank = self._bank << 12
+        site = self._pc | bank
+        stub = self._tramp_sites.get(site, -1)
+        tramp = self._tramps.get(stub)
+        if (tramp != None and tramp[0] == (adr | bank) and first <= (stub & 0xFFF) < first + size):
+            tramp[3].add(site)
+            self._tramp_note = '// trampoline 0x%04X' % stub
+            if (last):
+                self._note('info', 'trampoline', 'Branch via trampoline at 0x%04X' % stub, " ".join(ll))
+            return stub & 0xFFF
+        if (site not in self._tramp_failed):
+            if (name[0] == '.'):
+                name = self._last_global + name
+            self._tramp_requests.append((site, adr | bank, name, first | bank, size))
+            return -2
+        return -1
+
+    # the word at adr (of the current pass) does not continue at the next address
+    def _ends_flow(self, adr):
+        occ = self._occupied
+        w = occ[adr]
+        prev = occ[adr - 1] if (adr & 0xFFF) else -1
+        if (prev >= 0 and ((prev & 3 == 0 and ((prev >> 2) & 0xF) in (5, 7, 9, 11)) or
+                           (prev & 3 == 2 and 22 <= (prev >> 5) <= 27))):
+            return 0                    # address of a "then go to", the test may fail
+        if (w == 0x210 or w == 0x010 or w == 0x090):
+            return 1                    # return, keys -> rom address, a -> rom address
+        if (w & 3 == 3):                # go to, not "if n/c go to" after a carry operation
+            return not (prev >= 0 and prev & 3 == 2 and self._op_arith_cy[prev >> 5])
+        return 0
+
+    # free words for a trampoline to target in the window, not reached by falling
+    # through from the code before. In the rom of the target (a "go to", one cycle),
+    # else a "del sel rom" and a "go to" (two cycles) in the rom nearest to the branch.
+    # The "go to" is never on the last word of a rom. Returns the address or -1
+    def _free_stub(self, site, target, first, size):
+        occ = self._occupied
+        roms = list(range(first >> 8, (first + size) >> 8))
+        roms.sort(key=lambda r: (r != (target >> 8), abs(r - (site >> 8))))
+        for rom in roms:
+            n = 1 if (rom == (target >> 8)) else 2
+            start = rom << 8
+            adr = start - 1
+            while (adr >= (start & 0x1000) and occ[adr] < 0):
+                adr = adr - 1
+            safe = (adr >= (start & 0x1000) and self._ends_flow(adr))
+            for adr in range(start, start + 0x100 - n):
+                if (occ[adr] >= 0):
+                    safe = self._ends_flow(adr)
+                elif (safe and occ[adr + n - 1] < 0):
+                    return adr
+        return -1
+
+    # place the trampolines requested in a pass with stable labels, a trampoline to
+    # the same target in the window is shared. Returns the number of requests, the
+    # branches without room are reported in the next pass
+    def _place_trampolines(self):
+        placed = 0
+        for site, target, name, first, size in self._tramp_requests:
+            stub = -1
+            for adr, tramp in self._tramps.items():
+                if (tramp[0] == target and first <= adr < first + size):
+                    stub = adr
+                    break
+            if (stub < 0):
+                stub = self._free_stub(site, target, first, size)
+                if (stub >= 0):
+                    if ((stub >> 8) == (target >> 8)):
+                        words = ((target & 0xFF) << 2 | 0x003,)
+                    else:
+                        words = (((target >> 8) & 0xF) << 6 | 0x034, (target & 0xFF) << 2 | 0x003)
+                    self._tramps[stub] = [target, name, words, set()]
+                    self._occupied[stub:stub + len(words)] = words
+            if (stub < 0):
+                self._tramp_failed.add(site)    # reported as before
+            else:
+                self._tramp_sites[site] = stub
+            placed = placed + 1
+        self._tramp_requests = []
+        return placed
+
+    # put the trampolines used in the pass, after the source lines. A trampoline on
+    # words used by the code now (eg. after -O) is dropped, and the pass repeated
+    def _emit_trampolines(self, last, listing):
+        occ = self._occupied
+        for stub in sorted(self._tramps.keys()):
+            target, name, words, sites = self._tramps[stub]
+            if (len(sites) == 0):
+                del self._tramps[stub]
+                continue
+            if (max(occ[stub:stub + len(words)]) >= 0):
+                del self._tramps[stub]
+                self._delta_labels = 1
+                continue
+            occ[stub:stub + len(words)] = words
+            if (last and (self._only == None or self._only[stub])):
+                for i in range(len(words)):
+                    self._put(stub + i, words[i], 'go to ' + name)
+                if (listing != None):
+                    listing.append(('code', stub, '', words, 'go to ' + name, '// trampoline for ' +
+                                    ", ".join(['0x%04X' % site for site in sorted(sites)]), ''))
+
+    # the trampolines of the last assembly: (address, words, target, target name, [branch addresses])
+    def trampolines(self):
+        return [(adr, t[2], t[0], t[1], sorted(t[3])) for adr, t in sorted(self._tramps.items())]
+
     # drop optional leading 3 digit hex opcode before the opcode-mnemonic
     def _drop_hex_opcode(self, ll):
         if (len(ll) > 0 and len(ll[0]) == 3 and ll[0][0] >= '0' and ll[0][0] <= '3'):
@@ -736,8 +1820,40 @@ class HP67():
         if (len(ll) > 0 and len(ll[0]) == 3 and ll[0][0] >= '0' and ll[0][0] <= '3'):
             ll.pop(0)            # drop the second hex opcode
 
-    # do the assembly
-    def assemble(self, file_in, file_lst, file_pub, file_out0, file_out1, fw_type, display=0, mirror=0):
+    # pass 0 and pass 1, 2.. until the labels are stable, the last pass fills the
+    # rom image and records the listing entries (if listing)
+    # only: selected address ranges [(first, last)], the last pass checks, lists and
+    # stores only the lines starting in a selected range
+    # optimize: run the peephole optimizer when the labels are stable, and lay out again
+    # check: checks in every pass, done when the addresses converge (one pass less),
+    # no listing or optimizer
+    # trampolines: out of range branches go via trampolines in free words
+    # progress: print the passes (command line only, the APIs print nothing)
+    def _passes(self, lines, listing=1, defines=None, only=None, optimize=0, check=0, trampolines=0,
+                progress=0):
+        self._load_tables()
+        self._select_tables()
+        self._tramp = trampolines
+        self._tramps = {}
+        self._tramp_sites = {}
+        self._tramp_failed = set()
+        self._tramp_requests = []
+        self._tramp_note = ''
+        self._optimize = optimize
+        self._rewrites = {}
+        self._opt_fixed = {}
+        self._opt_base = set()
+        self._opt_dropped = set()
+        self._opt_pairs = {}
+        self._opt_warned = set()
+        self._opt_stats = {'tail-call': 0, 'jump-chain': 0, 'del-sel-rom': 0, 'n-p': 0,
+                           'cycles': 0, 'words': -1, 'size': 0, 'rounds': 0}
+        self._only = None
+        if (only != None):
+            self._only = bytearray(8192)
+            for first, end in only:
+                self._only[first:end + 1] = b'\x01' * (end + 1 - first)
+        self._predefines = dict(defines) if defines else {}
         self._last_global = ''
         self._pc = 0
         self._bank = 0
@@ -748,36 +1864,47 @@ class HP67():
         self._delta_labels = 0
         self._del_rom_force = 0
         self._del_sel_force_rom = 0
-        self._defines = {}
+        self._defines = dict(self._predefines)
         self._rom = 8192 * [0]
+        self._used = bytearray(8192)
         self._cur_define = ''
         self._do_line = True
         self._do_line_skip_elses = False
         self._do_line_stack = []  # save stack for _do_line when new #if/#ifdef
-        self._pub = None
-
-        f = open(file_in, 'rt')
-        lines = f.readlines()
-        f.close()
-
-        if (file_pub != ''):
-            self._pub = open(file_pub, 'wt')
-            self._pub.write(";;; PUBLICS FROM HP67 FW\n")
+        self._macros = {}
+        self._macro_memo = {}
+        self._decoded = {}
+        self._macro_count = 0
+        self._pass = 0
+        self._labels = {}
+        self._line_no = 0
+        self._diags = []
+        self._diag_keys = set()
+        self._dup_labels = set()
+        self._listing = [] if (listing and not check) else None
+        self._refs = None
 
         define = 0
         
         #
         # pass 0 - parsing labels
         #
-        print('pass 0')
-        for line in lines:
+        if (progress):
+            print('pass 0')
+        for line, raw in self._expand_macros(lines):
+            if (raw):
+                continue
             ll = line.split()
             ##print('ll=', " ".join(ll)) # for debug
             if (len(ll) > 0):
                 label = ''
                 if (line[0] > ' '): # first char non empty, this is a #if/endif or a label
                     # handle #define/ifdef/else/endif, comment or label
-                    define, label = self._handle_if_else_endif(ll)
+                    try:
+                        define, label = self._handle_if_else_endif(ll)
+                    except MyException as e:
+                        self._recover(e)
+                        define, label = 1, ''
                     if (len(label) > 0):
                         self._add_label(label, self._pc) # add the new label
                 else:
@@ -794,7 +1921,10 @@ class HP67():
                     code = -1
                     length = len(ll)
                     if (length > 0):
-                        code, length = self._find_opcode(ll, 0, 0)
+                        try:
+                            code, length = self._find_opcode(ll, 0, 0)
+                        except MyException as e:
+                            code, length = self._recover_opcode(e, ll)
                     if (code < 0):
                         length = len(ll)
                     if (self._del_rom_emit):
@@ -814,7 +1944,16 @@ class HP67():
         finished = 0
         last = 0
         self._pass = 0
+        if (check):
+            # the checks of a pass are valid once no label moved during it, the
+            # diagnostics of the passes before are dropped
+            last = 1
+            diags = list(self._diags)
+            diag_keys = set(self._diag_keys)
         while(finished == 0):
+            if (check):
+                self._diags = list(diags)
+                self._diag_keys = set(diag_keys)
             self._last_global = ''
             self._pc = 0
             self._bank = 0
@@ -825,15 +1964,45 @@ class HP67():
             self._delta_labels = 0
             self._del_rom_force = 0
             self._del_sel_force_rom = 0
-            self._defines = {}
+            self._defines = dict(self._predefines)
             self._cur_define = ''
             self._do_line = True
             self._do_line_skip_elses = False
+            self._macro_count = 0
+            self._used = bytearray(8192)
+            self._select_tables()
+            self._tramp_requests = []
+            occ = None
+            if (self._tramp):
+                occ = self._occupied = 8192 * [-1]
+                for tramp in self._tramps.values():
+                    tramp[3].clear()
 
             self._pass = self._pass + 1
-            print('pass %d' % self._pass)
-
-            for line in lines:
+            if (progress):
+                print('pass %d' % self._pass)
+            listing = self._listing if (last) else None
+            opt = [] if (self._optimize) else None
+            n = 0
+            if (last):
+                self._refs = set()
+                self._orgs = []
+                self._publics = []
+                if (self._listing != None):
+                    del self._listing[:]
+
+            for line, raw in self._expand_macros(lines):
+                sel = last
+                if (last and self._only != None):   # outside the selection: size and labels only
+                    sel = self._only[self._pc | (self._bank << 12)]
+                lst = listing if (sel) else None
+                n = n + 1
+                if (n in self._rewrites):
+                    line = self._rewrites[n][0]
+                if (raw):                # macro definition or invocation, list only
+                    if (lst != None):
+                        lst.append(('text', self._pc | (self._bank << 12), '', (), '', '', line))
+                    continue
                 ll = line.split()
                 label = ''
                 com_line = ''
@@ -842,7 +2011,11 @@ class HP67():
                 if (len(ll) > 0):
                     if (line[0] > ' '):
                         # handle #define/ifdef/else/endif (if any)
-                        define, label = self._handle_if_else_endif(ll)
+                        try:
+                            define, label = self._handle_if_else_endif(ll)
+                        except MyException as e:
+                            self._recover(e)
+                            define, label = 1, ''
                         if (len(label) > 0):
                             self._correct_label(label, self._pc) # update the address
                     else:
@@ -850,95 +2023,187 @@ class HP67():
                         label = ''
 
                     if (define):
-                        if (last):
-                            if (display):
-                                print('%X%03X %s' % (self._bank, self._pc, " ".join(ll[0:])))
-                            h.write('%s' % (line))
+                        if (lst != None):
+                            lst.append(('define', self._pc | (self._bank << 12), '', (), '', '', line))
                     elif (self._do_line):
                         self._drop_hex_opcode(ll)  # drop opcode before mnemonic (if any)
 
-                        label = label + 20*' '
-                        label = label[0:20]
                         code = -1
                         length = len(ll)
                         com = ''
+                        cy, ifthen = self._cy, self._ifthen
                         if length > 0:
                             if (ll[0][0:1] == '#' or ll[0][0:2] == '//'): # no opcode, just a full-line comment
                                 opcode = ''
                                 length = 0
                                 com_line = line
                             else:
-                                code, length = self._find_opcode(ll, 1, last)
+                                try:
+                                    code, length = self._find_opcode(ll, 1, sel)
+                                except MyException as e:
+                                    code, length = self._recover_opcode(e, ll)
                                 if (len(ll) > length):
                                     com = " ".join(ll[length:])
                                 else:
                                     com = ''
+                                if (self._tramp_note != ''):
+                                    com = (com + ' ' + self._tramp_note).lstrip()
+                                    self._tramp_note = ''
                                 if (length > 0):
                                     opcode = " ".join(ll[0:length])
-                                    if (len(opcode) < 30):
-                                        opcode = opcode + ' '*(30 - len(opcode))
-                                    else:
-                                        opcode = opcode[:27] + '...'
                                 else:
                                     opcode = ''
                         else:
                             opcode = ''
+                        adr = self._pc | (self._bank << 12)
+                        if (opt != None and (code >= 0 or opcode != '' or label != '')):
+                            if (self._del_rom_emit):
+                                words = (self._del_rom, code)
+                            else:
+                                words = (code,) if (code >= 0) else ()
+                            opt.append((n, adr, label != '', ll[0:length], words, cy, ifthen, self._last_global, line,
+                                        self._line_no))
+                        if (occ != None and code >= 0):
+                            if (self._del_rom_emit):
+                                occ[adr] = self._del_rom
+                                occ[adr + 1] = code
+                            else:
+                                occ[adr] = code
                         if (self._del_rom_emit):  # double op-codes!
-                            if (last):
-                                self._rom[self._pc | (self._bank << 12)] = self._del_rom
-                                self._rom[self._pc + 1 | (self._bank << 12)] = code
-                                if (display):
-                                    print('%X%03X %s %03X %03X %30s %s' % (self._bank, self._pc, label, self._del_rom, code, opcode, com))
-                                h.write('%X%03X %s %03X %03X %30s %s\n' % (self._bank, self._pc, label, self._del_rom, code, opcode, com))
+                            if (sel):
+                                self._put(adr, self._del_rom, opcode)
+                                self._put(adr + 1, code, opcode)
+                                if (lst != None):
+                                    lst.append(('code', adr, label, (self._del_rom, code), opcode, com, line))
                             self._pc = self._pc + 2
                             self._del_rom_emit = 0
                         elif (code >= 0):
-                            if (last):
-                                self._rom[self._pc | (self._bank << 12)] = code
-                                if (display):
-                                    print('%X%03X %s %03X     %s %s' % (self._bank, self._pc, label, code, opcode, com))
-                                h.write('%X%03X %s %03X     %s %s\n' % (self._bank, self._pc, label, code, opcode, com))
+                            if (sel):
+                                self._put(adr, code, opcode)
+                                if (lst != None):
+                                    lst.append(('code', adr, label, (code,), opcode, com, line))
                             self._pc = self._pc + 1
-                        else:
-                            if (last):
-                                if (opcode == ''):
-                                    if (len(com_line) > 0):           # only comment on this line
-                                        com_pos = com_line.find('#')
-                                        if (com_pos == 0):
-                                            com_pos = com_line.find('//')
-                                        if (com_pos == 0):
-                                            com_line = '     ' + com_line  # offset for whole line comment
-                                        elif (com_pos > 24):
-                                            com_line = '              ' + com_line # offset for partial line comm
-                                        if (display):
-                                            print(com_line[0:-1])
-                                        h.write('%s' % (com_line))
-                                    else:
-                                        h.write('%X%03X %s         %s\n' % (self._bank, self._pc, label, com))
-                                else:
-                                    if (display):
-                                        print('%X%03X %s         %s %s' % (self._bank, self._pc, label, opcode, com))
-                                    h.write('%X%03X %s         %s %s\n' % (self._bank, self._pc, label, opcode, com))
+                        elif (lst != None):
+                            if (opcode == '' and len(com_line) > 0):  # only comment on this line
+                                lst.append(('comment', adr, label, (), '', '', com_line))
+                            else:
+                                lst.append(('code', adr, label, (), opcode, com, line))
                         self._pc = self._pc & 0xFFF
+            if (self._tramp):
+                self._emit_trampolines(last, listing)
             if (self._delta_labels == 0):
-                if (last == 0):
-                    h = open(file_lst, 'wt')
+                if (last == 0 and not check):
+                    if (opt != None and self._peephole(opt) > 0):
+                        continue        # lines rewritten, lay out the labels again
+                if (self._tramp_requests and self._place_trampolines() > 0):
+                    continue            # branches redirected, the trampolines use free words only
+                if (last == 0 and not check):
                     last = 1
                 else:
                     finished = 1
-        h.close()
-        if (self._pub != None):
-            self._pub.close()
 
+    # the listing entries of the last assembly, one per source line:
+    # (kind, address, label, words, opcode, comment, text)
+    # kind is 'code', 'comment', 'define' (directive) or 'text' (macro lines),
+    # words are the 0, 1 or 2 generated words, text is the source line
+    def listing(self):
+        return self._listing
+
+    # one listing line for the file, and for the log (None: not shown)
+    def _list_line(self, entry):
+        kind, adr, label, words, opcode, com, text = entry
+        if (kind == 'text'):
+            return text, text[0:-1]
+        if (kind == 'define'):
+            return text, '%X%03X %s' % (adr >> 12, adr & 0xFFF, " ".join(text.split()))
+        if (kind == 'comment'):
+            com_pos = text.find('#')
+            if (com_pos == 0):
+                com_pos = text.find('//')
+            if (com_pos == 0):
+                text = '     ' + text  # offset for whole line comment
+            elif (com_pos > 24):
+                text = '              ' + text # offset for partial line comm
+            return text, text[0:-1]
+        label = (label + 20*' ')[0:20]
+        if (len(opcode) >= 30):
+            opcode = opcode[:27] + '...'
+        elif (len(opcode) > 0):
+            opcode = opcode + ' '*(30 - len(opcode))
+        if (len(words) == 2):
+            line = '%X%03X %s %03X %03X %30s %s' % (adr >> 12, adr & 0xFFF, label, words[0], words[1], opcode, com)
+        elif (len(words) == 1):
+            line = '%X%03X %s %03X     %s %s' % (adr >> 12, adr & 0xFFF, label, words[0], opcode, com)
+        elif (opcode == ''):
+            return '%X%03X %s         %s\n' % (adr >> 12, adr & 0xFFF, label, com), None
+        else:
+            line = '%X%03X %s         %s %s' % (adr >> 12, adr & 0xFFF, label, opcode, com)
+        return line + '\n', line
+
+    # render the listing of the last assembly, written to f if given, otherwise
+    # returned as text. display: print the listing too (--log)
+    def render_listing(self, f=None, display=0):
+        if (self._listing == None):
+            raise MyException('Error: no listing, assembled without listing')
+        out = []
+        for entry in self._listing:
+            line, shown = self._list_line(entry)
+            if (display and shown != None):
+                print(shown)
+            out.append(line)
+        text = ''.join(out)
+        if (f == None):
+            return text
+        f.write(text)
+
+    # the listing lines of the last assembly, rendered one at a time
+    def iter_listing(self):
+        if (self._listing == None):
+            raise MyException('Error: no listing, assembled without listing')
+        for entry in self._listing:
+            yield self._list_line(entry)[0]
+
+    # the (address, word) of each written word of the last assembly, in address order
+    def iter_words(self):
+        adr = self._used.find(1)
+        while (adr >= 0):
+            yield (adr, self._rom[adr])
+            adr = self._used.find(1, adr + 1)
+
+    # the firmware image, bank1 is optionally mirrored from bank0
+    def _fw_image(self, mirror=0):
+        image = list(self._rom)
+        if (mirror):
+            for i in range(4096):
+                if (i < 1024 or i >= 2048):
+                    if (image[i+4096] != 0):
+                        self._error('mirror', 'option mirror is used, but bank1 0x1800-0x1fff is not empty')
+                    image[i+4096] = image[i]  # mirror first 1k (1000-13ff) and last 2k (1800-1fff) from bank0
+        return image
+
+    # parse address ranges "0x1400-0x14ff,0x0200-0x02ff" (or a single address), returns [(first, last)]
+    def _parse_ranges(self, text):
+        ranges = []
+        for r in text.split(','):
+            w = r.split('-')
+            first = self._get_address(w[0].strip())
+            end = self._get_address(w[-1].strip())
+            if (len(w) > 2 or first > end or end > 0x1FFF):
+                self._error('range', 'Bad address range', r)
+            ranges.append((first, end))
+        return ranges
+
+    # the image outside the selected addresses (--only) is taken from base
+    def _merge_image(self, base, image):
+        return [image[i] if (self._only[i]) else base[i] for i in range(8192)]
+
+    # write the firmware image to f0 (and f1 for binary bank files), fw_type b, r, h or None
+    # returns the md5 sums of bank0 and bank1
+    # only: rom files hold only the selected addresses, if given
+    def _write_fw(self, f0, f1, fw_type, image, only=None):
+        from hashlib import md5
         m0 = md5()
         m1 = md5()
-        
-        #
-        # write output files bank, rom or header
-        #
-        file_type = 'wb' if (fw_type == 'b') else 'w'
-        f0 = open(file_out0, file_type) if (len(file_out0) > 0) else None
-        f1 = open(file_out1, file_type) if (len(file_out1) > 0) else None
 
         if (fw_type == 'r' or fw_type == 'h'):  # add config comment
             f0.write("/* source defines: %s */\n" % (self._defines))
@@ -949,12 +2214,12 @@ class HP67():
         # bank0 + header
         addr = 0
         for i in range(4096):
-            opc = self._rom[i]
+            opc = image[i]
             adata = bytes([opc & 0xff, opc >> 8])
             m0.update(adata)
             if (fw_type == 'b'):
                 f0.write(adata)
-            if (fw_type == 'r'):
+            if (fw_type == 'r' and (only == None or only[addr])):
                 self._write_rom(f0, addr, opc)
             if (fw_type == 'h'):
                 self._write_header(f0, addr, opc)
@@ -962,17 +2227,13 @@ class HP67():
 
         # bank1 + header
         for i in range(4096):
-            opc = self._rom[i+4096]
-            if (mirror and (i < 1024 or i >= 2048)):
-                if (mirror and opc != 0):
-                    raise MyException('Error: option mirror is used, but bank1 0x1800-0x1fff is not empty')
-                opc = self._rom[i]  # mirror first 1k (1000-13ff) and last 2k (1800-1fff) from bank1
+            opc = image[i+4096]
             adata = bytes([opc & 0xff, opc >> 8])
             m1.update(adata)
 
             if (fw_type == 'b'):
                 f1.write(adata)
-            if (fw_type == 'r'):
+            if (fw_type == 'r' and (only == None or only[addr])):
                 self._write_rom(f0, addr, opc)
             if (fw_type == 'h'):
                 self._write_header(f0, addr, opc)
@@ -980,12 +2241,353 @@ class HP67():
 
         if (fw_type == 'h'):
              f0.write("};\n")
-
-        if (f0 != None):
+        return m0, m1
+
+    # image as 16k bytes, little endian words as in the binary bank files
+    def _image_bytes(self, image):
+        from array import array
+        data = array('H', image)
+        if (sys.byteorder == 'big'):
+            data.byteswap()
+        return data.tobytes()
+
+    # the firmware image of the last assembly through the buffer protocol: a memoryview
+    # of 8192 words (format 'H', native byte order), eg. for numpy.frombuffer()
+    def image_buffer(self, mirror=0):
+        from array import array
+        return memoryview(array('H', self._fw_image(mirror)))
+
+    # shared memory image: header of 16 bytes, magic 'HP67', generation, number of
+    # words, reserved (little endian 32 bit), then the words as in the binary bank files.
+    # The generation is odd while the image is written, a reader copies the image when
+    # the generation is even, and copies again if it changed meanwhile
+    _shm_magic = b'HP67'
+    _shm_header = 16
+
+    # attach to the shared memory segment name, or create it. The segment is kept
+    # when the assembler exits, for the simulator
+    def _open_shm(self, name):
+        from multiprocessing import shared_memory
+        if (self._shm != None and self._shm.name.lstrip('/') == name.lstrip('/')):
+            return self._shm
+        size = self._shm_header + 2 * 8192
+        try:
+            shm = shared_memory.SharedMemory(name)
+        except FileNotFoundError:
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+            shm.buf[0:self._shm_header] = b'\0' * self._shm_header
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except (ImportError, AttributeError):
+            pass
+        if (shm.size < size or (bytes(shm.buf[0:4]) not in (self._shm_magic, b'\0\0\0\0'))):
+            shm.close()
+            self._error('shm', 'shared memory %s is not an HP67 image' % name)
+        if (self._shm != None):
+            self._shm.close()
+        self._shm = shm
+        return shm
+
+    # publish the firmware image (default: of the last assembly) in the shared memory
+    # segment name, returns the new generation
+    # only: selected addresses (see _passes), the other words of the segment are kept
+    def publish_image(self, name, image=None, only=None):
+        import struct
+        if (image == None):
+            image = self._fw_image()
+        shm = self._open_shm(name)
+        buf = shm.buf
+        h = self._shm_header
+        data = self._image_bytes(image)
+        generation = struct.unpack_from('<I', buf, 4)[0]
+        generation = generation + 2 if (generation & 1) else generation + 1
+        struct.pack_into('<4sII', buf, 0, self._shm_magic, generation, 8192)
+        if (only == None):
+            buf[h:h + 2 * 8192] = data
+        else:
+            for adr in range(8192):
+                if (only[adr]):
+                    buf[h + 2 * adr:h + 2 * adr + 2] = data[2 * adr:2 * adr + 2]
+        generation = generation + 1
+        struct.pack_into('<I', buf, 4, generation)
+        return generation
+
+    # read the image of a shared memory segment, eg. in a stand-in for the simulator
+    # returns (generation, image), or None if there is no new image: the generation is
+    # still the given one, or the image is being written
+    @classmethod
+    def read_shared_image(cls, name, generation=None):
+        import struct
+        from array import array
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(name)
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except (ImportError, AttributeError):
+            pass
+        try:
+            g = struct.unpack_from('<I', shm.buf, 4)[0]
+            if (g == generation or (g & 1)):
+                return None
+            words = array('H')
+            words.frombytes(bytes(shm.buf[cls._shm_header:cls._shm_header + 2 * 8192]))
+            if (struct.unpack_from('<I', shm.buf, 4)[0] != g):
+                return None
+        finally:
+            shm.close()
+        if (sys.byteorder == 'big'):
+            words.byteswap()
+        return (g, list(words))
+
+    # read a firmware image: x11-calc .rom file, 16k .bin file, or a pair of
+    # _bank0.bin/_bank1.bin files (give the bank0 file)
+    def _read_image(self, file_name):
+        from array import array
+        image = 8192 * [0]
+        if (file_name[-4:] == '.rom'):
+            f = open(file_name, 'rt')
+            for line in f:
+                w = line.split(':')
+                if (len(w) == 2 and w[0].strip().isdigit()):    # skip the defines comment
+                    addr = int(w[0], 8)
+                    if (addr < 8192):
+                        image[addr] = int(w[1], 8)
+            f.close()
+            return image
+        f = open(file_name, 'rb')
+        data = f.read()
+        f.close()
+        if (len(data) == 8192 and file_name[-9:] == 'bank0.bin'):
+            f = open(file_name[:-9] + 'bank1.bin', 'rb')
+            data = data + f.read()
+            f.close()
+        if (len(data) != 16384):
+            self._error('image', 'bad firmware image %s (16k .bin, _bank0.bin or .rom expected)' % file_name)
+        words = array('H')
+        words.frombytes(data)
+        if (sys.byteorder == 'big'):
+            words.byteswap()
+        return list(words)
+
+    # changed ranges between two images: [(start address, [words])]
+    # blocks of 64 words are compared at once, only changed blocks word by word
+    def _image_delta(self, base, image):
+        ranges = []
+        start = -1
+        for blk in range(0, 8192, 64):
+            if (base[blk:blk+64] == image[blk:blk+64]):
+                if (start >= 0):
+                    ranges.append((start, image[start:blk]))
+                    start = -1
+                continue
+            for i in range(blk, blk + 64):
+                if (base[i] != image[i]):
+                    if (start < 0):
+                        start = i
+                elif (start >= 0):
+                    ranges.append((start, image[start:i]))
+                    start = -1
+        if (start >= 0):
+            ranges.append((start, image[start:8192]))
+        return ranges
+
+    # text patch: "AAAA: WWW WWW ..." (hex), max 16 words per line
+    def _write_patch_text(self, f, ranges, file_base, base_md5, new_md5):
+        f.write("; asm67 patch\n")
+        f.write("; base md5 %s %s\n" % (base_md5, file_base))
+        f.write("; new md5 %s\n" % (new_md5))
+        f.write("; %d range(s), %d word(s)\n" % (len(ranges), sum([len(w) for a, w in ranges])))
+        for start, words in ranges:
+            for i in range(0, len(words), 16):
+                f.write("%04X: %s\n" % (start + i, " ".join(["%03X" % w for w in words[i:i+16]])))
+
+    # binary patch, little endian: "A67P", version (1 byte), 0 (1 byte), number of ranges (2 bytes),
+    # md5 of the base and the new image (16 bytes each), then per range: start address,
+    # number of words and the words (2 bytes each)
+    def _write_patch_bin(self, f, ranges, base_md5, new_md5):
+        import struct
+        f.write(struct.pack('<4sBBH16s16s', b'A67P', 1, 0, len(ranges),
+                            bytes.fromhex(base_md5), bytes.fromhex(new_md5)))
+        for start, words in ranges:
+            f.write(struct.pack('<HH%dH' % len(words), start, len(words), *words))
+
+    # read a text or binary patch, returns the ranges and the md5 of the base and the new image
+    def _read_patch(self, file_name):
+        import struct
+        f = open(file_name, 'rb')
+        data = f.read()
+        f.close()
+        ranges = []
+        if (data[0:4] == b'A67P'):
+            magic, version, res, n, base_md5, new_md5 = struct.unpack_from('<4sBBH16s16s', data)
+            if (version != 1):
+                self._error('patch', 'unknown patch version %d in %s' % (version, file_name))
+            pos = struct.calcsize('<4sBBH16s16s')
+            for i in range(n):
+                start, count = struct.unpack_from('<HH', data, pos)
+                ranges.append((start, list(struct.unpack_from('<%dH' % count, data, pos + 4))))
+                pos = pos + 4 + 2 * count
+            return ranges, base_md5.hex(), new_md5.hex()
+        base_md5 = ''
+        new_md5 = ''
+        for line in data.decode().splitlines():
+            ll = line.split()
+            if (len(ll) == 0):
+                continue
+            if (ll[0] == ';'):
+                if (ll[1:3] == ['base', 'md5']):
+                    base_md5 = ll[3]
+                elif (ll[1:3] == ['new', 'md5']):
+                    new_md5 = ll[3]
+                continue
+            try:
+                ranges.append((int(ll[0][:-1], 16), [int(w, 16) for w in ll[1:]]))
+            except ValueError:
+                self._error('patch', 'bad patch line in %s: %s' % (file_name, line))
+        return ranges, base_md5, new_md5
+
+    # write a text and a binary patch of the image against the baseline image
+    def _write_patch(self, image, patch_base, file_patch, file_patch_bin, base=None):
+        from hashlib import md5
+        if (base == None):
+            base = self._read_image(patch_base)
+        ranges = self._image_delta(base, image)
+        base_md5 = md5(self._image_bytes(base)).hexdigest()
+        new_md5 = md5(self._image_bytes(image)).hexdigest()
+        f = open(file_patch, 'wt')
+        self._write_patch_text(f, ranges, patch_base, base_md5, new_md5)
+        f.close()
+        f = open(file_patch_bin, 'wb')
+        self._write_patch_bin(f, ranges, base_md5, new_md5)
+        f.close()
+        print('Patch: %d range(s), %d word(s) changed' % (len(ranges), sum([len(w) for a, w in ranges])))
+
+    # apply a (text or binary) patch to a baseline image, the patched image is
+    # written as .rom, .h, 16k .bin or a pair of _bank0.bin/_bank1.bin files
+    def apply_patch(self, file_patch, file_base, file_out):
+        from hashlib import md5
+        ranges, base_md5, new_md5 = self._read_patch(file_patch)
+        image = self._read_image(file_base)
+        if (base_md5 != '' and md5(self._image_bytes(image)).hexdigest() != base_md5):
+            self._error('patch', 'patch %s does not match the base image %s' % (file_patch, file_base))
+        for start, words in ranges:
+            if (start + len(words) > 8192):
+                self._error('patch', 'patch range 0x%04X outside the image' % start)
+            image[start:start+len(words)] = words
+        if (new_md5 != '' and md5(self._image_bytes(image)).hexdigest() != new_md5):
+            self._error('patch', 'patched image md5 does not match %s' % file_patch)
+
+        f1 = None
+        if (file_out[-4:] == '.rom' or file_out[-2:] == '.h'):
+            fw_type = 'r' if (file_out[-4:] == '.rom') else 'h'
+            f0 = open(file_out, 'wt')
+        else:
+            fw_type = 'b'
+            f0 = open(file_out, 'wb')
+            if (file_out[-9:] == 'bank0.bin'):
+                f1 = open(file_out[:-9] + 'bank1.bin', 'wb')
+        try:
+            m0, m1 = self._write_fw(f0, f1 if (f1 != None) else f0, fw_type, image)
+        finally:
             f0.close()
-        if (f1 != None):
-            f1.close()
+            if (f1 != None):
+                f1.close()
+        print('Applied %d range(s) to %s, written to %s' % (len(ranges), file_base, file_out))
+        print('MD5 sums:')
+        print(' bank1:', m0.hexdigest())
+        print(' bank2:', m1.hexdigest())
 
+    # do the assembly
+    # only: address ranges (text, see _parse_ranges), only these are checked, listed and
+    # output: a partial rom file, or with patch_base a patch and the base image with
+    # the selected addresses replaced
+    def assemble(self, file_in, file_lst, file_pub, file_out0, file_out1, fw_type, display=0, mirror=0,
+                 diag=None, file_diag='', patch_base='', file_patch='', file_patch_bin='',
+                 usage=None, file_usage='', only='', reach=None, file_reach='', optimize=0, shm='',
+                 trampolines=0):
+        self._file_in = file_in
+        self._collect = 1 if diag else 0
+        self._pub = None
+        ranges = None
+        if (only != ''):
+            ranges = self._parse_ranges(only)
+            if (patch_base == '' and fw_type != None and fw_type != 'r'):
+                raise MyException('Error: --only gives a partial image, use --fwout r or --patch')
+            if (reach):
+                raise MyException('Error: --only gives a partial image, --reach not supported')
+
+        f = open(file_in, 'rt')
+        lines = f.readlines()
+        f.close()
+
+        if (file_pub != ''):
+            self._pub = open(file_pub, 'wt')
+            self._pub.write(";;; PUBLICS FROM HP67 FW\n")
+
+        try:
+            self._passes(lines, file_lst != '' or display, None, ranges, optimize, 0, trampolines, 1)
+        finally:
+            if (self._pub != None):
+                self._pub.close()
+            # the listing is written on errors too, up to the failing line
+            if (file_lst != ''):
+                h = open(file_lst, 'wt')
+                try:
+                    self.render_listing(h, display)
+                finally:
+                    h.close()
+            elif (display):
+                self.render_listing(None, display)
+
+        if (optimize):
+            self._report_opt()
+        if (trampolines):
+            tramps = self.trampolines()
+            print('Trampolines: %d, %d word(s)' % (len(tramps), sum([len(t[1]) for t in tramps])))
+        if (self._collect):
+            errors = self._report_diags(diag, file_diag)
+            if (errors > 0):
+                raise MyException('Error: %d error(s), no firmware output' % errors)
+
+        #
+        # write output files bank, rom or header
+        #
+        image = self._fw_image(mirror)
+        base = None
+        partial = self._only
+        if (self._only != None and patch_base != ''):
+            base = self._read_image(patch_base)
+            image = self._merge_image(base, image)
+            partial = None
+        file_type = 'wb' if (fw_type == 'b') else 'w'
+        f0 = open(file_out0, file_type) if (len(file_out0) > 0) else None
+        f1 = open(file_out1, file_type) if (len(file_out1) > 0) else None
+        try:
+            m0, m1 = self._write_fw(f0, f1, fw_type, image, partial)
+        finally:
+            if (f0 != None):
+                f0.close()
+            if (f1 != None):
+                f1.close()
+
+        if (patch_base != ''):
+            self._write_patch(image, patch_base, file_patch, file_patch_bin, base)
+        if (shm != ''):
+            print('Shared memory %s: generation %d' % (shm, self.publish_image(shm, image, partial)))
+            self._shm.close()
+            self._shm = None
+        if (usage):
+            self._report_usage(usage, file_usage)
+        if (reach):
+            self._report_reach(reach, file_reach)
+
+        if (partial != None):
+            print('MD5 sums: (partial image, %s only)' % only)
+            print(' bank1:', m0.hexdigest())
+            print(' bank2:', m1.hexdigest())
+            return
         print('MD5 sums:')
         print(' bank1 orig hp67: 8603efa8aadb3a6da3c39be41717be10')
         print('             new:', m0.hexdigest())
@@ -994,54 +2596,406 @@ class HP67():
         else:
             print(' bank2 orig hp67: 36db1b6fc49cecd88e080c4d01746267') # (1000-1400 and 1800-ffff = 0)')
         print('             new:', m1.hexdigest())
-        
-topcat = HP67()
-
-parser = argparse.ArgumentParser(description="HP67/97 Woodstock Assembler")
-parser.add_argument("input", help='Input file (.asm can be omitted)')
-parser.add_argument('--log', action='store_true', help='Output listing during assembly')
-parser.add_argument('--fwout', choices=['b', 'r', 'h'], help='Firmware output file type (b: binary bank files, r: x11-calc rom, h: C-header)')
-parser.add_argument('--pub', action='store_true', help='Output public file during assembly')
-parser.add_argument('--mirror', action='store_true', help='Mirror bank1 1000-13ff and 1800-1fff from bank0')
-args = parser.parse_args()
-
-fileBase = args.input
-log = 1 if args.log else 0
-mirror = 1 if args.mirror else 0
-
-# remove the .src or .asm extension if present
-if (fileBase[-4:] == ".src") or (fileBase[-4:] == ".asm"):
-    inputFile = fileBase
-    fileBase = fileBase[:-4]
-else:
-    inputFile = fileBase + ".asm"
-
-listFile  = fileBase + '.lst'
-fwout_file0=''
-fwout_file1=''
-
-if (args.fwout == 'b'):
-    fwout_file0 = fileBase + "_fw_bank0.bin"
-    fwout_file1 = fileBase + "_fw_bank1.bin"
-elif (args.fwout == 'r'):
-    fwout_file0 = fileBase + "_fw.rom"
-elif (args.fwout =='h'):
-    fwout_file0 = fileBase + "_fw.h"
-
-pubFile = ''
-if (args.pub):
-    pubFile = fileBase + ".pub"
-
-print('Assembling:  ', inputFile)
-print('Output Files:', listFile, '', pubFile, '', fwout_file0, '', fwout_file1)
-
-try:
-    topcat.assemble(inputFile, listFile, pubFile,
-                    fwout_file0, fwout_file1,
-                    args.fwout, log, mirror)
-
-except MyException as e:
-    print(e)
-
-except FileNotFoundError as e:
-    print(e)
+
+    # assemble an iterable of source lines, eg. a generator, a pipe or a socket file
+    # (str or bytes lines), all diagnostics are collected. The lines are read once,
+    # no files are written. Returns the number of errors and warnings, and the
+    # diagnostics; the outputs are read with iter_listing() and iter_words()
+    def assemble_lines(self, lines, defines=None, listing=1, optimize=0, file_in='<stream>', trampolines=0):
+        self._file_in = file_in
+        self._collect = 1
+        self._pub = None
+        source = []
+        for line in lines:
+            if (isinstance(line, bytes)):
+                line = line.decode()
+            if (line[-1:] != '\n'):
+                line = line + '\n'
+            source.append(line)
+        self._passes(source, listing, defines, None, optimize, 0, trampolines)
+        diags, errors, warnings = self._diag_summary()
+        return {'errors': errors, 'warnings': warnings, 'diagnostics': diags}
+
+    # check source text (or an iterable of lines) for an editor, on every change: the
+    # preprocessor, labels, opcodes and branches (range, target, last word) are checked,
+    # nothing is written. Returns the number of errors and warnings, and the diagnostics
+    def check(self, source, defines=None, file_in='<stdin>', trampolines=0):
+        self._file_in = file_in
+        self._collect = 1
+        self._pub = None
+        if (isinstance(source, str)):
+            source = source.splitlines(True)
+        self._passes(source, 0, defines, None, 0, 1, trampolines)
+        diags, errors, warnings = self._diag_summary()
+        return {'errors': errors, 'warnings': warnings, 'diagnostics': diags}
+
+    # assemble source text in memory, all diagnostics are collected
+    # formats: any of 'image', 'lst', 'listing' (entries), 'pub', 'rom', 'h', 'bin' (base64,
+    # bank0 + bank1), 'usage' and 'reach'
+    # returns a dict with the diagnostics, symbols, md5 sums and the requested outputs,
+    # firmware outputs are omitted if there were errors
+    # only: address ranges (text), the outputs hold only these, 'rom' is a partial rom file
+    # optimize: run the peephole optimizer, the result holds its report as 'optimize'
+    # shm: publish the image in this shared memory segment (see publish_image()), the
+    # result holds the new generation as 'generation'
+    # trampolines: out of range branches via trampolines, listed as 'trampolines'
+    def assemble_text(self, source, defines=None, formats=(), mirror=0, file_in='<source>', only='',
+                      optimize=0, shm='', trampolines=0):
+        import io
+        ranges = None
+        if (only != ''):
+            ranges = self._parse_ranges(only)
+            if ('h' in formats or 'bin' in formats or 'reach' in formats):
+                raise MyException('Error: only gives a partial image, h, bin and reach formats not supported')
+        self._file_in = file_in
+        self._collect = 1
+        self._pub = None
+        if ('pub' in formats):
+            self._pub = io.StringIO()
+            self._pub.write(";;; PUBLICS FROM HP67 FW\n")
+        self._passes(source.splitlines(True), 'lst' in formats or 'listing' in formats, defines, ranges, optimize,
+                     0, trampolines)
+
+        diags, errors, warnings = self._diag_summary()
+        result = {'errors': errors, 'warnings': warnings, 'diagnostics': diags,
+                  'symbols': dict(self._labels)}
+        if (optimize):
+            result['optimize'] = self.opt_stats()
+        if (trampolines):
+            result['trampolines'] = self.trampolines()
+        if ('lst' in formats):
+            result['lst'] = self.render_listing()
+        if ('listing' in formats):
+            result['listing'] = self._listing
+        if ('pub' in formats):
+            result['pub'] = self._pub.getvalue()
+        if ('usage' in formats):
+            result['usage'] = self.usage()
+        if ('reach' in formats):
+            result['reach'] = self.reachability()
+        if (errors > 0):
+            return result
+
+        image = self._fw_image(mirror)
+        m0, m1 = self._write_fw(None, None, None, image)
+        result['md5'] = [m0.hexdigest(), m1.hexdigest()]
+        if (shm != ''):
+            result['generation'] = self.publish_image(shm, image, self._only)
+        if ('image' in formats):
+            result['image'] = image
+        if ('rom' in formats):
+            f0 = io.StringIO()
+            self._write_fw(f0, None, 'r', image, self._only)
+            result['rom'] = f0.getvalue()
+        if ('h' in formats):
+            f0 = io.StringIO()
+            self._write_fw(f0, None, 'h', image)
+            result['h'] = f0.getvalue()
+        if ('bin' in formats):
+            import base64
+            f0 = io.BytesIO()
+            f1 = io.BytesIO()
+            self._write_fw(f0, f1, 'b', image)
+            result['bin'] = base64.b64encode(f0.getvalue() + f1.getvalue()).decode('ascii')
+        return result
+
+#
+# assembly server: JSON-RPC 2.0 requests, one per line, on stdin/stdout or a Unix socket
+#
+# {"jsonrpc": "2.0", "id": 1, "method": "assemble",
+#  "params": {"source": "...", "defines": {"HP97": 1}, "formats": ["image", "lst"]}}
+#
+# "path" can be used instead of "source", see assemble_text() for the result.
+# The requests are served in parallel by a pool of worker processes, each with
+# its own assembler instance.
+#
+_server_asm = None
+
+def _server_init(isa=None):
+    global _server_asm
+    _server_asm = HP67()
+    _server_asm._load_tables()
+    if (isa != None):
+        _server_asm.load_isa(isa)
+
+def _server_assemble(params):
+    if ('source' in params):
+        source = params['source']
+        file_in = params.get('path', '<source>')
+    else:
+        file_in = params['path']
+        f = open(file_in, 'rt')
+        source = f.read()
+        f.close()
+    _server_asm.set_dialect(params.get('dialect', 'any'))
+    if (params.get('check', 0)):
+        return _server_asm.check(source, params.get('defines'), file_in, params.get('trampolines', 0))
+    return _server_asm.assemble_text(source, params.get('defines'), params.get('formats', ()),
+                                     params.get('mirror', 0), file_in, params.get('only', ''),
+                                     params.get('optimize', 0), params.get('shm', ''),
+                                     params.get('trampolines', 0))
+
+def _server_reply(rid, result=None, error=None):
+    import json
+    reply = {'jsonrpc': '2.0', 'id': rid}
+    if (error != None):
+        reply['error'] = {'code': error[0], 'message': error[1]}
+    else:
+        reply['result'] = result
+    return json.dumps(reply)
+
+# parse a request line and submit it to the pool, reply(text) is called with the
+# reply when it is ready. Returns an event set after the reply, or None if the
+# request was rejected
+def _server_dispatch(pool, line, reply):
+    import json
+    try:
+        request = json.loads(line)
+    except ValueError:
+        reply(_server_reply(None, error=(-32700, 'Parse error')))
+        return None
+    if (not isinstance(request, dict) or 'method' not in request):
+        reply(_server_reply(None, error=(-32600, 'Invalid Request')))
+        return None
+    rid = request.get('id')
+    notify = 'id' not in request
+    if (request['method'] not in ('assemble', 'check')):
+        if (not notify):
+            reply(_server_reply(rid, error=(-32601, 'Method not found')))
+        return None
+    params = request.get('params', {})
+    if (not isinstance(params, dict) or ('source' not in params and 'path' not in params)):
+        if (not notify):
+            reply(_server_reply(rid, error=(-32602, 'Invalid params: "source" or "path" expected')))
+        return None
+    if (request['method'] == 'check'):
+        params = dict(params, check=1)
+
+    import threading
+    replied = threading.Event()
+
+    def done(future):
+        try:
+            if (not notify):
+                try:
+                    text = _server_reply(rid, future.result())
+                except (MyException, OSError) as e:
+                    text = _server_reply(rid, error=(-32000, str(e)))
+                except Exception as e:
+                    text = _server_reply(rid, error=(-32603, 'Internal error: %r' % e))
+                reply(text)
+        finally:
+            replied.set()
+
+    pool.submit(_server_assemble, params).add_done_callback(done)
+    return replied
+
+# run the server, address is a Unix socket path or '-' for stdin/stdout
+# isa: an isa definition file for the workers, see HP67.load_isa()
+def serve(address, workers=None, isa=None):
+    import os
+    import stat
+    import threading
+    from concurrent.futures import ProcessPoolExecutor
+
+    pool = ProcessPoolExecutor(workers, initializer=_server_init, initargs=(isa,))
+    if (address == '-'):
+        lock = threading.Lock()
+        out = sys.stdout
+
+        def reply(text):
+            with lock:
+                out.write(text + '\n')
+                out.flush()
+
+        pending = []
+        for line in sys.stdin:
+            if (line.strip() != ''):
+                replied = _server_dispatch(pool, line, reply)
+                if (replied != None):
+                    pending.append(replied)
+        for replied in pending:
+            replied.wait()
+        pool.shutdown()
+        return
+
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            lock = threading.Lock()
+
+            def reply(text):
+                with lock:
+                    self.wfile.write((text + '\n').encode())
+                    self.wfile.flush()
+
+            pending = []
+            for line in self.rfile:
+                if (line.strip() != b''):
+                    replied = _server_dispatch(pool, line.decode(), reply)
+                    if (replied != None):
+                        pending.append(replied)
+            for replied in pending:
+                replied.wait()
+
+    # remove a stale socket from an earlier run, but nothing else
+    if (os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode)):
+        os.unlink(address)
+    server = socketserver.ThreadingUnixStreamServer(address, Handler)
+    server.daemon_threads = True
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    import signal
+    signal.signal(signal.SIGTERM, stop)
+    print('Serving on', address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(address)
+        pool.shutdown()
+
+
+def main():
+    import argparse
+    topcat = HP67()
+
+    parser = argparse.ArgumentParser(description="HP67/97 Woodstock Assembler")
+    parser.add_argument("input", nargs='?', help='Input file (.asm can be omitted)')
+    parser.add_argument('--log', action='store_true', help='Output listing during assembly')
+    parser.add_argument('--no-lst', action='store_true', help='Do not write the listing file')
+    parser.add_argument('--fwout', choices=['b', 'r', 'h'], help='Firmware output file type (b: binary bank files, r: x11-calc rom, h: C-header)')
+    parser.add_argument('--pub', action='store_true', help='Output public file during assembly')
+    parser.add_argument('-O', dest='optimize', action='store_true', help='Peephole optimizer: tail calls, jump chains, redundant del sel rom and n -> p')
+    parser.add_argument('--trampolines', action='store_true', help='Out of range branches and jumps on the last word of a ROM via trampolines in free words')
+    parser.add_argument('--mirror', action='store_true', help='Mirror bank1 1000-13ff and 1800-1fff from bank0')
+    parser.add_argument('--dialect', help='Mnemonic spellings: any (default), short, long or strict (only the first one used)')
+    parser.add_argument('--isa', metavar='FILE', help='Instruction set definition (json) instead of the built-in HP67/97 one')
+    parser.add_argument('--isa-dump', metavar='FILE', help='Write the built-in HP67/97 instruction set definition (json) to FILE')
+    parser.add_argument('--diag', choices=['text', 'json'], help='Collect all errors and warnings, report them at the end (json: diagnostics file)')
+    parser.add_argument('--check', action='store_true', help='Check the source read from stdin, no output files (input: file name for the diagnostics, --diag json: json on stdout)')
+    parser.add_argument('--usage', choices=['text', 'json'], help='Output a ROM usage report: used and free words per bank and ROM (json: usage file)')
+    parser.add_argument('--reach', choices=['text', 'json'], help='Output a reachability report: unreachable words and unused labels (json: reach file)')
+    parser.add_argument('--only', metavar='RANGES', help='Check, list and output only the address ranges, eg. 0x1400-0x14ff,0x0200-0x02ff')
+    parser.add_argument('--shm', metavar='NAME', help='Publish the image in the shared memory segment NAME, for a running simulator')
+    parser.add_argument('--patch', metavar='BASE', help='Output a patch against the baseline image BASE (.rom, 16k .bin or _bank0.bin)')
+    parser.add_argument('--apply', nargs=3, metavar=('PATCH', 'BASE', 'OUT'), help='Apply PATCH to the image BASE, write OUT (.rom, .h, .bin or _bank0.bin)')
+    parser.add_argument('--server', metavar='SOCKET', help="Run as assembly server, JSON-RPC on a Unix socket ('-': stdin/stdout)")
+    parser.add_argument('--workers', type=int, help='Number of server worker processes (default: number of CPUs)')
+    args = parser.parse_args()
+
+    if (args.isa_dump != None):
+        f = open(args.isa_dump, 'wt')
+        HP67.dump_isa(f)
+        f.close()
+        return
+    try:
+        if (args.isa != None):
+            topcat.load_isa(args.isa)
+        if (args.dialect != None):
+            topcat.set_dialect(args.dialect)
+    except (MyException, OSError) as e:
+        print(e)
+        return
+    if (args.server != None):
+        serve(args.server, args.workers, args.isa)
+        return
+    if (args.apply != None):
+        try:
+            topcat.apply_patch(args.apply[0], args.apply[1], args.apply[2])
+        except (MyException, OSError) as e:
+            print(e)
+        return
+    if (args.check):
+        try:
+            result = topcat.check(sys.stdin.read(), None, args.input if (args.input != None) else '<stdin>',
+                                  1 if args.trampolines else 0)
+        except MyException as e:
+            print(e)
+            return
+        if (args.diag == 'json'):
+            import json
+            json.dump(result, sys.stdout, indent=1)
+            sys.stdout.write('\n')
+        else:
+            topcat._report_diags('text', '')
+        return
+    if (args.input == None):
+        parser.error('the following arguments are required: input')
+
+    fileBase = args.input
+    log = 1 if args.log else 0
+    mirror = 1 if args.mirror else 0
+
+    # remove the .src or .asm extension if present
+    if (fileBase[-4:] == ".src") or (fileBase[-4:] == ".asm"):
+        inputFile = fileBase
+        fileBase = fileBase[:-4]
+    else:
+        inputFile = fileBase + ".asm"
+
+    listFile  = fileBase + '.lst' if (not args.no_lst) else ''
+    fwout_file0=''
+    fwout_file1=''
+
+    if (args.fwout == 'b'):
+        fwout_file0 = fileBase + "_fw_bank0.bin"
+        fwout_file1 = fileBase + "_fw_bank1.bin"
+    elif (args.fwout == 'r'):
+        fwout_file0 = fileBase + "_fw.rom"
+    elif (args.fwout =='h'):
+        fwout_file0 = fileBase + "_fw.h"
+
+    pubFile = ''
+    if (args.pub):
+        pubFile = fileBase + ".pub"
+
+    diagFile = ''
+    if (args.diag == 'json'):
+        diagFile = fileBase + "_diag.json"
+
+    usageFile = ''
+    if (args.usage == 'json'):
+        usageFile = fileBase + "_usage.json"
+
+    reachFile = ''
+    if (args.reach == 'json'):
+        reachFile = fileBase + "_reach.json"
+
+    patchBase = ''
+    patchFile = ''
+    patchBinFile = ''
+    if (args.patch):
+        patchBase = args.patch
+        patchFile = fileBase + ".patch"
+        patchBinFile = fileBase + "_patch.bin"
+
+    print('Assembling:  ', inputFile)
+    print('Output Files:', listFile, '', pubFile, '', fwout_file0, '', fwout_file1, '', diagFile,
+          '', patchFile, '', patchBinFile, '', usageFile, '', reachFile)
+
+    try:
+        topcat.assemble(inputFile, listFile, pubFile,
+                        fwout_file0, fwout_file1,
+                        args.fwout, log, mirror,
+                        args.diag, diagFile,
+                        patchBase, patchFile, patchBinFile,
+                        args.usage, usageFile,
+                        args.only if (args.only != None) else '',
+                        args.reach, reachFile,
+                        1 if args.optimize else 0,
+                        args.shm if (args.shm != None) else '',
+                        1 if args.trampolines else 0)
+
+    except MyException as e:
+        print(e)
+
+    except FileNotFoundError as e:
+        print(e)
+
+if __name__ == '__main__':
+    main()
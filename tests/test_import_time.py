@@ -0,0 +1,63 @@
+# import time budget of asm67: the module is imported for each run of the assembler
+# (eg. by an editor integration), so it must not compile the opcode tables or
+# import argparse, json, socket etc. at import
+#
+# run: python3 -m unittest discover -s tests
+
+import os
+import sys
+import subprocess
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# cumulative import time of asm67 in us (about 1ms measured, with the .pyc)
+BUDGET = 10000
+
+# modules which must only be imported when needed
+LAZY = ('argparse', 'json', 'socket', 'socketserver', 'multiprocessing', 'hashlib', 'marshal', 'mmap')
+
+
+def import_time():
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)    # measure with the .pyc, as installed
+    env.pop('ASM67_TABLE_CACHE', None)
+    cmd = [sys.executable, '-X', 'importtime', '-c', 'import asm67']
+    subprocess.run(cmd, cwd=ROOT, env=env, check=True, capture_output=True)   # write the .pyc
+    best = None
+    for i in range(3):
+        res = subprocess.run(cmd, cwd=ROOT, env=env, check=True, capture_output=True, text=True)
+        names = []
+        total = None
+        for line in res.stderr.splitlines():
+            if (not line.startswith('import time:') or '[us]' in line):
+                continue
+            fields = line[12:].split('|')
+            name = fields[2].strip()
+            if (name == 'asm67'):
+                total = int(fields[1])
+                break
+            if (fields[2].startswith('  ')):
+                names.append(name)
+            else:
+                names = []          # imported by site, before asm67
+        if (best == None or total < best[0]):
+            best = (total, names)
+    return best
+
+
+class ImportTimeTest(unittest.TestCase):
+
+    def test_budget(self):
+        total, names = import_time()
+        self.assertIsNotNone(total)
+        self.assertLess(total, BUDGET, 'import asm67 took %dus' % total)
+
+    def test_lazy_imports(self):
+        total, names = import_time()
+        for name in LAZY:
+            self.assertNotIn(name, names, '%s imported by asm67' % name)
+
+
+if __name__ == '__main__':
+    unittest.main()
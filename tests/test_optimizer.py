@@ -0,0 +1,129 @@
+# peephole optimizer (-O): the rewrites, their guards, and the code which must not move
+#
+# run: python3 -m unittest discover -s tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import asm67
+
+
+def assemble(source, optimize=1):
+    return asm67.HP67().assemble_text(source, formats=['image'], optimize=optimize)
+
+
+def codes(result):
+    return [d['code'] for d in result['diagnostics']]
+
+
+class OptimizerTest(unittest.TestCase):
+
+    def test_tail_call(self):
+        r = assemble('start:  0 -> a[w]\n'
+                     '        jsb sub\n'
+                     '        return\n'
+                     'sub:    return\n')
+        self.assertEqual(r['errors'], 0)
+        self.assertEqual(r['optimize']['tail-call'], 1)
+        self.assertEqual(r['image'][0:3], [0x01A, 0x00B, 0x210])    # go to sub (0x002)
+
+    def test_tail_call_after_carry(self):
+        r = assemble('start:  a + 1 -> a[w]\n'
+                     '        jsb sub\n'
+                     '        return\n'
+                     'sub:    return\n')
+        self.assertEqual(r['optimize']['tail-call'], 0)
+
+    def test_jump_chain(self):
+        r = assemble('start:  go to hop\n'
+                     '        return\n'
+                     'hop:    go to final\n'
+                     'final:  return\n')
+        self.assertEqual(r['optimize']['jump-chain'], 1)
+        self.assertEqual(r['image'][0], 0x003 << 2 | 0x003)
+
+    def test_jump_chain_out_of_range(self):
+        # "if n/c go to" stays in its rom, the final target is in rom 1
+        r = assemble('start:  a + 1 -> a[w]\n'
+                     '        if n/c go to hop\n'
+                     '        return\n'
+                     'hop:    go to final\n'
+                     '        org 0x100\n'
+                     'final:  return\n')
+        self.assertEqual(r['errors'], 0)
+        self.assertEqual(r['optimize']['jump-chain'], 0)
+
+    def test_n_p(self):
+        r = assemble('start:  3 -> p\n'
+                     '        0 -> a[w]\n'
+                     '        3 -> p\n'
+                     '        return\n')
+        self.assertEqual(r['optimize']['n-p'], 1)
+        self.assertEqual(r['image'][0:3], [0x27C, 0x01A, 0x210])
+
+    def test_n_p_guards(self):
+        for source in ('start:  3 -> p\n'           # label in between
+                       'x:      3 -> p\n'
+                       '        return\n',
+                       'start:  3 -> p\n'           # after a carry operation
+                       '        a + 1 -> a[w]\n'
+                       '        3 -> p\n'
+                       '        return\n',
+                       'start:  3 -> p\n'           # p changed
+                       '        p - 1 -> p\n'
+                       '        3 -> p\n'
+                       '        return\n',
+                       'start:  if p # 3\n'         # the address word 0x27C looks like "3 -> p"
+                       '          then go to x\n'
+                       '        3 -> p\n'
+                       '        return\n'
+                       '        org 0x27C\n'
+                       'x:      return\n'):
+            r = assemble(source)
+            self.assertEqual(r['errors'], 0)
+            self.assertEqual(r['optimize']['n-p'], 0, source)
+
+    def test_keep_sel_rom_and_bank_switch(self):
+        for source in ('start:  5 -> p\n'
+                       '        5 -> p\n'
+                       '        sel rom 1 there\n'
+                       '        org 0x103\n'
+                       'there:  return\n',
+                       'start:  5 -> p\n'
+                       '        5 -> p\n'
+                       '        bank switch there\n'
+                       '        bank 1\n'
+                       '        org 0x1003\n'
+                       'there:  return\n'):
+            r = assemble(source)
+            self.assertEqual(r['errors'], 0, r['diagnostics'])
+            self.assertIn('opt-fixed', codes(r))
+            self.assertEqual(r['image'], assemble(source, 0)['image'])
+
+    def test_keep_direct_branch_target(self):
+        source = ('        3 -> p\n'
+                  '        3 -> p\n'
+                  '        go to $05\n'
+                  '        nop\n'
+                  '        nop\n'
+                  'tgt:    0 -> a[w]\n'
+                  '        return\n')
+        r = assemble(source)
+        self.assertIn('opt-fixed', codes(r))
+        self.assertEqual(r['image'], assemble(source, 0)['image'])
+
+    def test_rollback_out_of_range(self):
+        # without the second "3 -> p" the "then go to" moves to 0x3FF, its target stays in the next 1k
+        source = '        3 -> p\n        3 -> p\n' + 0x3FD * '        nop\n'
+        source = source + '        if s2 = 1\n          then go to tgt\n        nop\ntgt:    return\n'
+        r = assemble(source)
+        self.assertEqual(r['errors'], 0, r['diagnostics'])
+        self.assertIn('opt-rollback', codes(r))
+        self.assertEqual(r['optimize']['n-p'], 0)
+        self.assertEqual(r['image'], assemble(source, 0)['image'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+# reachability report (--reach)
+#
+# run: python3 -m unittest discover -s tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import asm67
+
+
+def reach(source):
+    result = asm67.HP67().assemble_text(source, formats=['reach'])
+    assert result['errors'] == 0, result['diagnostics']
+    return result['reach']
+
+
+class ReachTest(unittest.TestCase):
+
+    def test_address_word_not_del_sel_rom(self):
+        # the address word 0x0B4 of the "then go to" looks like "del sel rom 2"
+        r = reach('start:  if p # 3\n'
+                  '          then go to x\n'
+                  '        go to y\n'
+                  'y:      go to start\n'
+                  '        org 0xB4\n'
+                  'x:      return\n')
+        self.assertEqual(r['unreachable'], 0)
+        self.assertEqual(r['runs'], [])
+
+    def test_del_sel_rom(self):
+        r = reach('start:  del sel rom 1\n'
+                  '        go to far\n'
+                  '        return\n'
+                  '        org 0x100\n'
+                  'far:    return\n')
+        self.assertEqual(r['runs'], [[0x0002, 1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# trampolines (--trampolines): the branch words and the trampolines placed in free words
+#
+# run: python3 -m unittest discover -s tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import asm67
+
+
+def assemble(source):
+    return asm67.HP67().assemble_text(source, formats=['image'], trampolines=1)
+
+
+class TrampolineTest(unittest.TestCase):
+
+    # one trampoline (address, words, target) for the branch at site
+    def check(self, r, site, adr, words, target):
+        self.assertEqual(r['errors'], 0, r['diagnostics'])
+        self.assertEqual([t[0:3] + (t[4],) for t in r['trampolines']], [(adr, words, target, [site])])
+        self.assertEqual(tuple(r['image'][adr:adr + len(words)]), words)
+
+    def test_then_go_to_out_of_1k(self):
+        r = assemble('start:  if s3 = 1\n'
+                     '          then go to far\n'
+                     '        return\n'
+                     '        org 0x400\n'
+                     'far:    return\n')
+        self.check(r, 0x001, 0x003, (0x134, 0x003), 0x400)     # del sel rom 4, go to 0x400
+        self.assertEqual(r['image'][0x001], 0x003)
+
+    def test_if_n_c_go_to_out_of_rom(self):
+        r = assemble('start:  a + 1 -> a[w]\n'
+                     '        if n/c go to far\n'
+                     '        return\n'
+                     '        org 0x100\n'
+                     'far:    return\n')
+        self.check(r, 0x001, 0x003, (0x074, 0x003), 0x100)     # del sel rom 1, go to 0x100
+        self.assertEqual(r['image'][0x001], 0x003 << 2 | 0x003)
+
+    def test_go_to_on_last_word(self):
+        r = assemble('start:  go to x\n'
+                     '        org 0x0ff\n'
+                     'x:      go to start\n'
+                     '        org 0x110\n'
+                     '        return\n')
+        self.check(r, 0x0FF, 0x100, (0x034, 0x003), 0x000)     # in the next rom
+        self.assertEqual(r['image'][0x0FF], 0x000 << 2 | 0x003)
+
+    def test_jsb_on_last_word(self):
+        r = assemble('start:  jsb sub\n'
+                     '        return\n'
+                     'sub:    return\n'
+                     '        org 0x0ff\n'
+                     '        jsb sub\n'
+                     '        go to start\n')
+        # 0x100 is the return address, the go to there takes 2 words
+        self.check(r, 0x0FF, 0x102, (0x034, 0x00B), 0x002)
+        self.assertEqual(r['image'][0x0FF], 0x002 << 2 | 0x001)
+
+    def test_jsb_not_on_return_address(self):
+        r = assemble('start:  jsb sub\n'
+                     '        return\n'
+                     'sub:    return\n'
+                     '        org 0x0ff\n'
+                     '        jsb sub\n'
+                     '        org 0x101\n'
+                     '        return\n')
+        self.check(r, 0x0FF, 0x102, (0x034, 0x00B), 0x002)
+        # no free word after the return address: no trampoline, the error as without the option
+        r = assemble('start:  jsb sub\n'
+                     '        return\n'
+                     'sub:    return\n'
+                     '        org 0x0ff\n'
+                     '        jsb sub\n')
+        self.assertEqual(r['trampolines'], [])
+        self.assertEqual([d['code'] for d in r['diagnostics'] if (d['severity'] == 'error')], ['last-word'])
+
+    def test_shared(self):
+        r = assemble('start:  a + 1 -> a[w]\n'
+                     '        if n/c go to far\n'
+                     '        a + 1 -> a[w]\n'
+                     '        if n/c go to far\n'
+                     '        return\n'
+                     '        org 0x100\n'
+                     'far:    return\n')
+        self.assertEqual(r['errors'], 0)
+        self.assertEqual([(t[0], t[4]) for t in r['trampolines']], [(0x005, [0x001, 0x003])])
+
+
+if __name__ == '__main__':
+    unittest.main()